@@ -0,0 +1,37 @@
+import csv
+import os
+import zlib
+
+CITIES_FILE = os.getenv('CITIES_FILE', os.path.join(os.path.dirname(__file__), 'cities.csv'))
+
+def parse_shard(shard: str) -> tuple:
+    """Parse a shard specification in the form "i/n" into (index, count)"""
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid shard "{shard}", expected the form i/n')
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Invalid shard "{shard}", index must be in [0, {count})')
+
+    return index, count
+
+def shard_of(query: str, count: int) -> int:
+    """Deterministic shard of a city, stable when the catalog grows"""
+    return zlib.crc32(query.encode('utf-8')) % count
+
+def load_cities(path: str = None, shard: str = None) -> list:
+    """Read the city catalog, keeping only the cities of the chosen shard"""
+    with open(path or CITIES_FILE, 'r', encoding='utf-8', newline='') as f:
+        cities = [row['query'] or row['city'] for row in csv.DictReader(f)]
+
+    if shard:
+        index, count = parse_shard(shard)
+        cities = [city for city in cities if shard_of(city, count) == index]
+
+    return cities
+
+def catalog_names(path: str = None) -> dict:
+    """Catalog city name of every query, e.g. {"Salvador,BA,BR": "Salvador"}"""
+    with open(path or CITIES_FILE, 'r', encoding='utf-8', newline='') as f:
+        return {row['query'] or row['city']: row['city'] for row in csv.DictReader(f)}
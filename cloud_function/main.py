@@ -1,15 +1,36 @@
 import functions_framework
 import os
+import time
 import requests
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
 from datetime import datetime
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from cities import load_cities, catalog_names
+from rate_limit import rate_limited_get
+from spool import Spool
+from stages import Stage, StagedPipeline
+from schemas import (OpenWeatherCurrent, WeatherApiForecast, WeatherApiCurrent, PayloadError,
+                     decode_openweather_current, decode_weatherapi_forecast, decode_weatherapi_current)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def extract_city_weather_data(city: str, api_key: str) -> dict:
+# Worker threads per pipeline stage, and rows loaded per insert
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', '4'))
+LOAD_WORKERS = int(os.getenv('LOAD_WORKERS', '1'))
+LOAD_BATCH_ROWS = int(os.getenv('LOAD_BATCH_ROWS', '50'))
+LOAD_BATCH_SECONDS = float(os.getenv('LOAD_BATCH_SECONDS', '5'))
+
+# Rows that failed to load, replayed at the start of the next invocation
+capitals_spool = Spool('weather_capitals')
+forecasts_spool = Spool('weather_forecasts')
+
+def extract_city_weather_data(city: str, api_key: str, on_request=None) -> OpenWeatherCurrent:
     """Extract weather data from OpenWeatherMap API"""
     api_url = 'https://api.openweathermap.org/data/2.5/weather'
     
@@ -20,72 +41,230 @@ def extract_city_weather_data(city: str, api_key: str) -> dict:
     }
     
     try:
-        response = requests.get(api_url, params=params, timeout=10)
+        response = rate_limited_get('openweather', api_url, params, on_request)
         response.raise_for_status()
         logger.info(f"Successfully fetched data for {city}")
-        return response.json()
+        return decode_openweather_current(response.content)
     except requests.exceptions.RequestException as e:
         logger.error(f'Error fetching data for {city}: {e}')
         return None
+    except PayloadError as e:
+        logger.error(f'Error decoding data for {city}: {e}')
+        return None
 
-def transform_city_weather_data(data: dict) -> dict:
-    """Transform raw weather data"""
+def transform_city_weather_data(data: OpenWeatherCurrent) -> dict:
+    """Transform decoded weather data"""
     if not data:
         return None
         
-    try:
-        transformed = {
-            'timestamp': datetime.fromtimestamp(data['dt']).isoformat(),
-            'city': data['name'],
-            'temperature': round(data['main']['temp'], 2),
-            'feels_like_temp': round(data['main']['feels_like'], 2),
-            'humidity': data['main']['humidity'],
-            'wind_speed': data['wind']['speed'],
-            'description': data['weather'][0]['description'],
-            'icon_url': f"https://openweathermap.org/img/wn/{data['weather'][0]['icon']}@2x.png",
-            'longitude': data['coord']['lon'],
-            'latitude': data['coord']['lat']
-        }
-        return transformed
-    except KeyError as e:
-        logger.error(f"Missing key in weather data: {e}")
-        return None
+    return {
+        'timestamp': datetime.fromtimestamp(data.dt).isoformat(),
+        'city': data.name,
+        'temperature': round(data.main.temp, 2),
+        'feels_like_temp': round(data.main.feels_like, 2),
+        'humidity': data.main.humidity,
+        'wind_speed': data.wind.speed,
+        'description': data.weather[0].description,
+        'icon_url': f"https://openweathermap.org/img/wn/{data.weather[0].icon}@2x.png",
+        'longitude': data.coord.lon,
+        'latitude': data.coord.lat,
+        'source': 'openweather'
+    }
 
-def load_to_bigquery(data: dict, project_id: str) -> bool:
-    """Load data to BigQuery"""
+def load_rows_to_bigquery(rows: list, table_id: str) -> bool:
+    """Load a batch of rows to BigQuery with a single insert"""
     try:
-        client = bigquery.Client(project=project_id)
-        table_id = f"{project_id}.weather_data.weather_capitals"
-        
-        rows = [data]
+        client = bigquery.Client(project=table_id.split('.')[0])
         errors = client.insert_rows_json(table_id, rows)
-        
+
         if errors:
-            logger.error(f"BigQuery insert errors: {errors}")
+            logger.error(f"BigQuery insert errors for {table_id}: {errors}")
             return False
-        
-        logger.info(f"Successfully loaded data for {data['city']}")
+
+        logger.info(f"Successfully loaded {len(rows)} rows to {table_id}")
         return True
-        
     except Exception as e:
         logger.error(f"BigQuery error: {e}")
         return False
 
+# HEDGED CURRENT CONDITIONS
+
+# Hedge to WeatherAPI once OpenWeather is slower than this percentile of its recent calls
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '2.0'))
+HEDGE_MIN_SAMPLES = 20
+
+primary_latencies = deque(maxlen=200)
+latencies_lock = threading.Lock()
+hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv('HEDGE_WORKERS', '8')))
+
+def hedge_delay() -> float:
+    """Seconds to wait for the primary provider before sending the hedged request"""
+    with latencies_lock:
+        samples = sorted(primary_latencies)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))]
+
+def get_weatherapi_current(city: str, api_key: str) -> WeatherApiCurrent:
+    """Extract current conditions from WeatherAPI.com"""
+    api_url = 'https://api.weatherapi.com/v1/current.json'
+
+    params = {
+        'key': api_key,
+        'q': city,
+        'aqi': 'no'
+    }
+
+    try:
+        response = rate_limited_get('weatherapi', api_url, params)
+        response.raise_for_status()
+        logger.info(f"Successfully fetched current conditions for {city} from WeatherAPI")
+        return decode_weatherapi_current(response.content)
+    except requests.exceptions.RequestException as e:
+        logger.error(f'Error fetching current conditions for {city}: {e}')
+        return None
+    except PayloadError as e:
+        logger.error(f'Error decoding current conditions for {city}: {e}')
+        return None
+
+def transform_weatherapi_current(data: WeatherApiCurrent, city: str) -> dict:
+    """Normalize WeatherAPI current conditions to the weather_capitals schema"""
+    if not data:
+        return None
+
+    current = data.current
+    return {
+        'timestamp': datetime.fromtimestamp(current.last_updated_epoch).isoformat(),
+        # Keep the catalog name so both sources land under the same city
+        'city': city,
+        'temperature': round(current.temp_c, 2),
+        'feels_like_temp': round(current.feelslike_c, 2),
+        'humidity': current.humidity,
+        'wind_speed': round(current.wind_kph / 3.6, 2),  # m/s, like OpenWeather metric units
+        'description': current.condition.text.lower(),
+        'icon_url': f"https:{current.condition.icon}",
+        'longitude': data.location.lon,
+        'latitude': data.location.lat,
+        'source': 'weatherapi'
+    }
+
+def fetch_openweather_row(city: str, api_key: str, on_request=None) -> dict:
+    sent = []
+
+    def request_sent():
+        sent.append(time.monotonic())
+        if on_request:
+            on_request()
+
+    row = transform_city_weather_data(extract_city_weather_data(city, api_key, request_sent))
+    # Only the HTTP call is measured, not the wait for a pool thread or a rate limit token
+    if row and sent:
+        with latencies_lock:
+            primary_latencies.append(time.monotonic() - sent[-1])
+    return row
+
+def fetch_weatherapi_row(city: str, api_key: str, name: str = None) -> dict:
+    return transform_weatherapi_current(get_weatherapi_current(city, api_key), name or city)
+
+def extract_current_conditions(city: str, openweather_key: str, weatherapi_key: str = None, name: str = None) -> dict:
+    """
+    Current conditions for a city from OpenWeather, hedged with WeatherAPI:
+    when OpenWeather fails or is slower than its recent latency percentile,
+    the same city is requested from WeatherAPI and the first good answer wins.
+    name is the catalog name stored for WeatherAPI rows, defaulting to the query
+    """
+    sent = threading.Event()
+    primary = hedge_pool.submit(fetch_openweather_row, city, openweather_key, sent.set)
+    primary.add_done_callback(lambda _: sent.set())
+
+    # The hedge timer starts once the request is sent, so throttling by
+    # our own rate limiter never triggers a hedge
+    sent.wait()
+    try:
+        row = primary.result(timeout=hedge_delay())
+        if row or not weatherapi_key:
+            return row
+    except TimeoutError:
+        if not weatherapi_key:
+            return primary.result()
+
+    logger.info(f"Hedging {city} to WeatherAPI")
+    secondary = hedge_pool.submit(fetch_weatherapi_row, city, weatherapi_key, name)
+
+    for future in as_completed([primary, secondary]):
+        try:
+            row = future.result()
+        except Exception as e:
+            logger.error(f"Unexpected error extracting {city}: {e}")
+            continue
+        if row:
+            return row
+
+    return None
+
+CAPITALS_SCHEMA_READY = False
+
+def ensure_source_column(project_id: str):
+    """Add the source column to weather_capitals tables created before it existed"""
+    global CAPITALS_SCHEMA_READY
+    if CAPITALS_SCHEMA_READY:
+        return
+
+    client = bigquery.Client(project=project_id)
+    try:
+        table = client.get_table(f"{project_id}.weather_data.weather_capitals")
+    except NotFound:
+        logger.warning("weather_capitals does not exist yet, skipping the source column check")
+        return
+    if 'source' not in [field.name for field in table.schema]:
+        table.schema = list(table.schema) + [bigquery.SchemaField("source", "STRING")]
+        client.update_table(table, ["schema"])
+        logger.info("Added source column to weather_capitals")
+    CAPITALS_SCHEMA_READY = True
+
+# Optional read API (read_api/) refreshed with every row loaded
+READ_API_URL = os.getenv('READ_API_URL')
+READ_API_TOKEN = os.getenv('READ_API_TOKEN')
+
+def publish_to_read_api(observations: list = None, forecasts: list = None):
+    """Push freshly loaded rows to the read API's in-memory index"""
+    if not READ_API_URL or not (observations or forecasts):
+        return
+
+    try:
+        response = requests.post(
+            f"{READ_API_URL.rstrip('/')}/refresh",
+            json={'observations': observations or [], 'forecasts': forecasts or []},
+            headers={'Authorization': f'Bearer {READ_API_TOKEN}'},
+            timeout=10
+        )
+        response.raise_for_status()
+        logger.info(f"Read API refreshed: {response.json()}")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Failed to refresh the read API: {e}")
+
+def get_shard(request) -> str:
+    """Read the optional shard ("i/n") from the query string or JSON body"""
+    shard = request.args.get('shard') if request.args else None
+    if not shard:
+        body = request.get_json(silent=True) or {}
+        shard = body.get('shard')
+    return shard
+
 @functions_framework.http
 def get_current_weather(request):
     """Main ETL function triggered by HTTP request"""
     
-    # Brazilian capitals
-    cities = [
-        "Aracaju", "Belém", "Belo Horizonte", "Boa Vista", "Brasília", 
-        "Campo Grande", "Cuiabá", "Curitiba", "Florianópolis", "Fortaleza", 
-        "Goiânia", "João Pessoa", "Macapá", "Maceió", "Manaus", "Natal", 
-        "Palmas", "Porto Alegre", "Porto Velho", "Recife", "Rio Branco", 
-        "Rio de Janeiro", "Salvador", "São Luís", "São Paulo", "Teresina", "Vitória"
-    ]
+    # Cities of the requested shard (?shard=i/n), or the whole catalog
+    try:
+        cities = load_cities(shard=get_shard(request))
+    except ValueError as e:
+        return {'error': str(e)}, 400
     
     # Get environment variables
     api_key = os.getenv('OPENWEATHER_API_KEY')
+    weatherapi_key = os.getenv('WEATHERAPI_KEY')  # Optional, enables hedged requests
     project_id = os.getenv('GCP_PROJECT')
     
     if not api_key:
@@ -94,48 +273,70 @@ def get_current_weather(request):
     if not project_id:
         return {'error': 'GCP_PROJECT not set'}, 400
     
+    ensure_source_column(project_id)
+
     results = {
         'total_cities': len(cities),
         'successful': 0,
         'failed': 0,
-        'errors': []
+        'errors': [],
+        'sources': {},
+        'replayed': capitals_spool.replay(
+            lambda rows: load_rows_to_bigquery(rows, f"{project_id}.weather_data.weather_capitals")
+        ),
     }
     
-    for city in cities:
+    table_id = f"{project_id}.weather_data.weather_capitals"
+    loaded_rows = []
+    results_lock = threading.Lock()
+    names = catalog_names()
+
+    def extract(city: str) -> dict:
+        # Extract and transform, hedged across providers
         try:
-            # Extract
-            raw_data = extract_city_weather_data(city, api_key)
-            
-            if raw_data:
-                # Transform
-                clean_data = transform_city_weather_data(raw_data)
-                
-                if clean_data:
-                    # Load
-                    if load_to_bigquery(clean_data, project_id):
-                        results['successful'] += 1
-                    else:
-                        results['failed'] += 1
-                        results['errors'].append(f"Failed to load {city} to BigQuery")
-                else:
-                    results['failed'] += 1
-                    results['errors'].append(f"Failed to transform data for {city}")
-            else:
-                results['failed'] += 1
-                results['errors'].append(f"Failed to extract data for {city}")
-                
+            clean_data = extract_current_conditions(city, api_key, weatherapi_key, names.get(city, city))
         except Exception as e:
-            results['failed'] += 1
-            results['errors'].append(f"Unexpected error for {city}: {str(e)}")
             logger.error(f"Unexpected error processing {city}: {e}")
+            with results_lock:
+                results['errors'].append(f"Unexpected error for {city}: {str(e)}")
+            return None
+
+        if not clean_data:
+            with results_lock:
+                results['errors'].append(f"Failed to extract data for {city}")
+        return clean_data
+
+    def load(rows: list) -> list:
+        success = load_rows_to_bigquery(rows, table_id)
+        with results_lock:
+            if not success:
+                capitals_spool.append(rows)
+                results['errors'].append(
+                    f"Failed to load {', '.join(row['city'] for row in rows)} to BigQuery, spooled for the next run"
+                )
+                return None
+            loaded_rows.extend(rows)
+            for row in rows:
+                results['sources'][row['source']] = results['sources'].get(row['source'], 0) + 1
+        return rows
+
+    # API calls for some cities overlap with the loads of others
+    stats = StagedPipeline([
+        Stage('extract', extract, workers=EXTRACT_WORKERS),
+        Stage('load', load, workers=LOAD_WORKERS, batch_size=LOAD_BATCH_ROWS, batch_seconds=LOAD_BATCH_SECONDS),
+    ]).run(cities)
+    results['successful'] = stats['load']['passed']
+    results['failed'] = len(cities) - results['successful']
     
+    capitals_spool.seal()
+    publish_to_read_api(observations=loaded_rows)
     logger.info(f"ETL completed: {results['successful']}/{results['total_cities']} successful")
     return results
 
 
 # FORECAST ETL
 
-def get_weatherapi_data(city: str, api_key: str) -> dict:
+def get_weatherapi_data(city: str, api_key: str) -> WeatherApiForecast:
     """Extract 3-day forecast data from WeatherAPI.com"""
     api_url = 'https://api.weatherapi.com/v1/forecast.json'
     
@@ -148,63 +349,44 @@ def get_weatherapi_data(city: str, api_key: str) -> dict:
     }
     
     try:
-        response = requests.get(api_url, params=params, timeout=10)
+        response = rate_limited_get('weatherapi', api_url, params)
         response.raise_for_status()
         logger.info(f"Successfully fetched forecast for {city} from WeatherAPI")
-        return response.json()
+        return decode_weatherapi_forecast(response.content)
     except requests.exceptions.RequestException as e:
         logger.error(f'Error fetching forecast for {city}: {e}')
         return None
+    except PayloadError as e:
+        logger.error(f'Error decoding forecast for {city}: {e}')
+        return None
 
-def transform_weatherapi_forecast(data: dict) -> dict:
-    """Transforms raw WeatherAPI forecast data for the last available day."""
-    if not data or 'forecast' not in data:
+def transform_weatherapi_forecast(data: WeatherApiForecast, city: str = None) -> dict:
+    """Transforms decoded WeatherAPI forecast data for the last available day."""
+    if not data:
         return None
     
-    try:
-        last_day_forecast = data['forecast']['forecastday'][-1]
-        city_name = data['location']['name']
-        forecast_date = last_day_forecast['date']
-
-        transformed = {
-            'forecast_id': f"{city_name.lower().replace(' ','_')}-weatherapi-{forecast_date}",
-            'city': city_name,
-            'source': 'weatherapi',
-            'forecast_made_at': datetime.now().isoformat(),
-            'forecast_for_date': forecast_date,
-            'predicted_temp': round(last_day_forecast['day']['avgtemp_c'], 2),
-            'predicted_description': last_day_forecast['day']['condition']['text'],
-        }
-        return transformed
-    except (KeyError, IndexError) as e:
-        logger.error(f"Missing key or index in WeatherAPI forecast data: {e}")
-        return None
+    last_day_forecast = data.forecast.forecastday[-1]
+    # Keep the catalog name so forecasts join the observations of the same city
+    city_name = city or data.location.name
+    forecast_date = last_day_forecast.date
 
-def load_forecast_to_bigquery(data: dict, project_id: str) -> bool:
-    """Loads a single transformed forecast record into BigQuery."""
-    try:
-        client = bigquery.Client(project=project_id)
-        table_id = f"{project_id}.weather_data.weather_forecasts"
-        
-        errors = client.insert_rows_json(table_id, [data])
-        
-        if errors:
-            logger.error(f"BigQuery insert errors for forecast: {errors}")
-            return False
-        
-        logger.info(f"Successfully loaded forecast for {data['city']} to BigQuery")
-        return True
-    except Exception as e:
-        logger.error(f"BigQuery forecast loading error: {e}")
-        return False
+    return {
+        'forecast_id': f"{city_name.lower().replace(' ','_')}-weatherapi-{forecast_date}",
+        'city': city_name,
+        'source': 'weatherapi',
+        'forecast_made_at': datetime.now().isoformat(),
+        'forecast_for_date': forecast_date,
+        'predicted_temp': round(last_day_forecast.day.avgtemp_c, 2),
+        'predicted_description': last_day_forecast.day.condition.text,
+    }
 
 @functions_framework.http
 def get_weather_forecasts(request):
     """Main ETL function for collecting and storing weather forecasts."""
-    cities = [ "Aracaju", "Belém", "Belo Horizonte", "Boa Vista", "Brasília", "Campo Grande", "Cuiabá", 
-              "Curitiba", "Florianópolis", "Fortaleza", "Goiânia", "João Pessoa", "Macapá", "Maceió", 
-              "Manaus", "Natal", "Palmas", "Porto Alegre", "Porto Velho", "Recife", "Rio Branco", 
-              "Rio de Janeiro", "Salvador", "São Luís", "São Paulo", "Teresina", "Vitória" ]
+    try:
+        cities = load_cities(shard=get_shard(request))
+    except ValueError as e:
+        return {'error': str(e)}, 400
     
     api_key = os.getenv('WEATHERAPI_KEY')
     project_id = os.getenv('GCP_PROJECT')
@@ -214,14 +396,32 @@ def get_weather_forecasts(request):
         logger.error(msg)
         return {'error': msg}, 500
 
-    successful_loads = 0
-    for city in cities:
-        raw_data = get_weatherapi_data(city, api_key)
-        if raw_data:
-            transformed_data = transform_weatherapi_forecast(raw_data)
-            if transformed_data:
-                if load_forecast_to_bigquery(transformed_data, project_id):
-                    successful_loads += 1
+    forecasts_spool.replay(
+        lambda rows: load_rows_to_bigquery(rows, f"{project_id}.weather_data.weather_forecasts")
+    )
+
+    table_id = f"{project_id}.weather_data.weather_forecasts"
+    names = catalog_names()
+    loaded_forecasts = []
+    spool_lock = threading.Lock()
+
+    def load(rows: list) -> list:
+        success = load_rows_to_bigquery(rows, table_id)
+        with spool_lock:
+            if not success:
+                forecasts_spool.append(rows)
+                return None
+            loaded_forecasts.extend(rows)
+        return rows
+
+    StagedPipeline([
+        Stage('extract', lambda city: (get_weatherapi_data(city, api_key), names.get(city, city)), workers=EXTRACT_WORKERS),
+        Stage('transform', lambda extracted: transform_weatherapi_forecast(*extracted)),
+        Stage('load', load, workers=LOAD_WORKERS, batch_size=LOAD_BATCH_ROWS, batch_seconds=LOAD_BATCH_SECONDS),
+    ]).run(cities)
+    forecasts_spool.seal()
+    publish_to_read_api(forecasts=loaded_forecasts)
+    successful_loads = len(loaded_forecasts)
     
     response_msg = f"ETL process completed. Successfully loaded forecasts for {successful_loads}/{len(cities)} cities."
     logger.info(response_msg)
@@ -0,0 +1,223 @@
+import functions_framework
+import os
+import bisect
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+import msgspec
+from google.cloud import bigquery
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Shared secret the ETL sends when pushing freshly loaded rows
+READ_API_TOKEN = os.getenv('READ_API_TOKEN')
+
+class LatestIndex:
+    """
+    Latest observation and forecast per city, kept in memory.
+
+    Responses are serialized once per change and cached with their ETag,
+    so a read is a dict lookup. Cities are also kept sorted by latitude,
+    so a bounding box only scans the latitude band it covers.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.observations = {}
+        self.forecasts = {}
+        self.latitude_index = ([], [])
+        self.responses = {}
+
+    @staticmethod
+    def _normalize(row: dict) -> dict:
+        # BigQuery returns NUMERIC columns as Decimal and timestamps as datetime,
+        # while the ETL pushes floats and ISO strings
+        normalized = {}
+        for key, value in row.items():
+            if isinstance(value, Decimal):
+                value = float(value)
+            elif isinstance(value, datetime):
+                value = value.replace(tzinfo=None).isoformat()
+            normalized[key] = value
+        return normalized
+
+    def update(self, observations: list = (), forecasts: list = ()) -> int:
+        """Merge rows into the index, keeping only the newest per city"""
+        changed = 0
+        with self.lock:
+            for row in map(self._normalize, observations):
+                current = self.observations.get(row['city'])
+                if current is None or row['timestamp'] > current['timestamp']:
+                    self.observations[row['city']] = row
+                    changed += 1
+
+            for row in map(self._normalize, forecasts):
+                current = self.forecasts.get(row['city'])
+                if current is None or row['forecast_made_at'] >= current['forecast_made_at']:
+                    self.forecasts[row['city']] = row
+                    changed += 1
+
+            if changed:
+                by_latitude = sorted(
+                    (row['latitude'], city) for city, row in self.observations.items()
+                    if row.get('latitude') is not None
+                )
+                self.latitude_index = ([latitude for latitude, _ in by_latitude], [city for _, city in by_latitude])
+                self.responses = {}
+        return changed
+
+    @staticmethod
+    def _encode(value) -> tuple:
+        """Serialized body and its ETag"""
+        body = msgspec.json.encode(value)
+        return body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+    def _response(self, key: str, build) -> tuple:
+        """Serialized body and ETag for a cacheable response"""
+        cached = self.responses.get(key)
+        if cached is None:
+            with self.lock:
+                cached = self._encode(build())
+                self.responses[key] = cached
+        return cached
+
+    def latest(self) -> tuple:
+        return self._response('latest', lambda: list(self.observations.values()))
+
+    def city(self, name: str) -> tuple:
+        if name not in self.observations and name not in self.forecasts:
+            return None
+        return self._response(f'city:{name}', lambda: {
+            'observation': self.observations.get(name),
+            'forecast': self.forecasts.get(name),
+        })
+
+    def bbox(self, min_lat: float, max_lat: float, min_lon: float, max_lon: float) -> tuple:
+        # Bounding boxes are too varied to cache, but still get an ETag
+        latitudes, cities = self.latitude_index
+        start = bisect.bisect_left(latitudes, min_lat)
+        end = bisect.bisect_right(latitudes, max_lat)
+        rows = (self.observations[city] for city in cities[start:end])
+        return self._encode([row for row in rows if min_lon <= row['longitude'] <= max_lon])
+
+index = LatestIndex()
+next_sync = 0.0
+sync_lock = threading.Lock()
+
+# POST /refresh reaches a single instance, so every instance also reloads
+# from BigQuery this often to pick up what was pushed to the others
+INDEX_TTL_SECONDS = int(os.getenv('INDEX_TTL_SECONDS', '300'))
+# Reloads only scan rows this much older than the newest one already indexed
+INDEX_LOOKBACK_HOURS = int(os.getenv('INDEX_LOOKBACK_HOURS', '24'))
+
+def since(rows: dict, field: str) -> str:
+    """Lower bound of the rows to reload, everything when the index is empty"""
+    if not rows:
+        return '1970-01-01T00:00:00'
+    newest = max(datetime.fromisoformat(str(row[field])) for row in rows.values())
+    return (newest - timedelta(hours=INDEX_LOOKBACK_HOURS)).isoformat()
+
+def sync(project_id: str):
+    """Fill the index from BigQuery on the first request, then refresh it every INDEX_TTL_SECONDS"""
+    global next_sync
+    with sync_lock:
+        if time.monotonic() < next_sync:
+            return
+        next_sync = time.monotonic() + INDEX_TTL_SECONDS
+
+        with index.lock:
+            observations_since = since(index.observations, 'timestamp')
+            forecasts_since = since(index.forecasts, 'forecast_made_at')
+
+        client = bigquery.Client(project=project_id)
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('observations_since', 'STRING', observations_since),
+            bigquery.ScalarQueryParameter('forecasts_since', 'STRING', forecasts_since),
+        ])
+        try:
+            observations = client.query(f"""
+                SELECT * FROM `{project_id}.weather_data.weather_capitals`
+                WHERE timestamp > CAST(@observations_since AS TIMESTAMP)
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY city ORDER BY timestamp DESC) = 1
+            """, job_config=job_config).result()
+            forecasts = client.query(f"""
+                SELECT * FROM `{project_id}.weather_data.weather_forecasts`
+                WHERE CAST(forecast_made_at AS DATETIME) > CAST(@forecasts_since AS DATETIME)
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY city ORDER BY forecast_made_at DESC) = 1
+            """, job_config=job_config).result()
+            changed = index.update([dict(row) for row in observations], [dict(row) for row in forecasts])
+        except Exception as e:
+            # Keep serving what is indexed, the next sync will try again
+            logger.error(f"Failed to sync the index from BigQuery: {e}")
+            return
+
+        logger.info(f"Index synced, {changed} rows updated, {len(index.observations)} cities")
+
+def refresh(project_id: str):
+    """
+    Sync the index once INDEX_TTL_SECONDS have passed. Only the first fill
+    of an empty index blocks the request, later refreshes run on a
+    background thread while requests keep reading the current index.
+    """
+    if time.monotonic() < next_sync:
+        return
+    if not index.observations:
+        sync(project_id)
+    elif not sync_lock.locked():
+        threading.Thread(target=sync, args=(project_id,), daemon=True).start()
+
+def json_response(body: bytes, etag: str, request):
+    if etag and etag in request.headers.get('If-None-Match', ''):
+        return '', 304, {'ETag': etag}
+    headers = {'Content-Type': 'application/json'}
+    if etag:
+        headers['ETag'] = etag
+    return body, 200, headers
+
+@functions_framework.http
+def read_weather(request):
+    """
+    Read API for the latest weather per city:
+    GET  /latest                  latest observation of every city
+    GET  /city/<name>             latest observation and forecast of a city
+    GET  /bbox?min_lat=&max_lat=&min_lon=&max_lon=
+    POST /refresh                 rows pushed by the ETL after each load
+    """
+    project_id = os.getenv('GCP_PROJECT')
+    path = request.path.rstrip('/')
+
+    if request.method == 'POST' and path == '/refresh':
+        if not READ_API_TOKEN or request.headers.get('Authorization') != f'Bearer {READ_API_TOKEN}':
+            return {'error': 'Unauthorized'}, 401
+        body = request.get_json(silent=True) or {}
+        changed = index.update(body.get('observations', []), body.get('forecasts', []))
+        return {'updated': changed}, 200
+
+    if request.method != 'GET':
+        return {'error': 'Method not allowed'}, 405
+
+    if project_id:
+        refresh(project_id)
+
+    if path == '/latest':
+        return json_response(*index.latest(), request)
+
+    if path.startswith('/city/'):
+        response = index.city(path[len('/city/'):])
+        if response is None:
+            return {'error': 'City not found'}, 404
+        return json_response(*response, request)
+
+    if path == '/bbox':
+        try:
+            bounds = [float(request.args[name]) for name in ('min_lat', 'max_lat', 'min_lon', 'max_lon')]
+        except (KeyError, ValueError):
+            return {'error': 'min_lat, max_lat, min_lon and max_lon are required numbers'}, 400
+        return json_response(*index.bbox(*bounds), request)
+
+    return {'error': 'Not found'}, 404
@@ -0,0 +1,100 @@
+import msgspec
+from typing import Annotated, Optional
+
+# Typed views of the API payloads. Only the fields the pipeline uses are
+# declared: msgspec skips everything else while decoding straight from the
+# response bytes and validates types in the same pass. Structs are
+# slot-based and untracked by the GC, so each record stays cheap.
+
+class PayloadError(ValueError):
+    """Raised when an API response does not match the expected schema"""
+
+class Coord(msgspec.Struct, gc=False):
+    lon: float
+    lat: float
+
+class Main(msgspec.Struct, gc=False):
+    temp: float
+    feels_like: float
+    humidity: int
+
+class Wind(msgspec.Struct, gc=False):
+    speed: float
+
+class Condition(msgspec.Struct, gc=False):
+    description: str
+    icon: str
+
+class OpenWeatherCurrent(msgspec.Struct, gc=False):
+    dt: int
+    name: str
+    main: Main
+    wind: Wind
+    weather: Annotated[list[Condition], msgspec.Meta(min_length=1)]
+    coord: Coord
+
+_openweather_current_decoder = msgspec.json.Decoder(OpenWeatherCurrent)
+
+def decode_openweather_current(payload: bytes) -> OpenWeatherCurrent:
+    """Decode and validate an OpenWeather current weather response"""
+    try:
+        return _openweather_current_decoder.decode(payload)
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        raise PayloadError(f'Invalid OpenWeather payload: {e}') from e
+
+class WeatherApiCondition(msgspec.Struct, gc=False):
+    text: str
+
+class WeatherApiDay(msgspec.Struct, gc=False):
+    avgtemp_c: float
+    condition: WeatherApiCondition
+
+class WeatherApiForecastDay(msgspec.Struct, gc=False):
+    date: str
+    day: WeatherApiDay
+
+class WeatherApiForecastDays(msgspec.Struct, gc=False):
+    forecastday: Annotated[list[WeatherApiForecastDay], msgspec.Meta(min_length=1)]
+
+class WeatherApiLocation(msgspec.Struct, gc=False):
+    name: str
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+
+class WeatherApiForecast(msgspec.Struct, gc=False):
+    location: WeatherApiLocation
+    forecast: WeatherApiForecastDays
+
+_weatherapi_forecast_decoder = msgspec.json.Decoder(WeatherApiForecast)
+
+def decode_weatherapi_forecast(payload: bytes) -> WeatherApiForecast:
+    """Decode and validate a WeatherAPI forecast response"""
+    try:
+        return _weatherapi_forecast_decoder.decode(payload)
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        raise PayloadError(f'Invalid WeatherAPI payload: {e}') from e
+
+class WeatherApiCurrentCondition(msgspec.Struct, gc=False):
+    text: str
+    icon: str
+
+class WeatherApiCurrentConditions(msgspec.Struct, gc=False):
+    last_updated_epoch: int
+    temp_c: float
+    feelslike_c: float
+    humidity: int
+    wind_kph: float
+    condition: WeatherApiCurrentCondition
+
+class WeatherApiCurrent(msgspec.Struct, gc=False):
+    location: WeatherApiLocation
+    current: WeatherApiCurrentConditions
+
+_weatherapi_current_decoder = msgspec.json.Decoder(WeatherApiCurrent)
+
+def decode_weatherapi_current(payload: bytes) -> WeatherApiCurrent:
+    """Decode and validate a WeatherAPI current conditions response"""
+    try:
+        return _weatherapi_current_decoder.decode(payload)
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        raise PayloadError(f'Invalid WeatherAPI payload: {e}') from e
@@ -0,0 +1,130 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Items waiting between two stages, beyond which the upstream stage blocks
+STAGE_QUEUE_SIZE = int(os.getenv('STAGE_QUEUE_SIZE', '64'))
+
+# Tells a worker that its upstream stage is finished
+_DONE = object()
+
+class Stage:
+    """
+    One step of a StagedPipeline
+
+    Parameters:
+    name (str): Name used in the stats and error messages
+    fn (callable): Called with each item (or a list of items when batching),
+                   returns the item for the next stage or None to drop it
+    workers (int): Threads running the stage
+    batch_size (int): Items handed to fn at once, 1 to call it per item
+    batch_seconds (float): Longest wait for a batch to fill up
+    """
+
+    def __init__(self, name: str, fn, workers: int = 1, batch_size: int = 1, batch_seconds: float = 5.0):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.batch_seconds = batch_seconds
+
+class StagedPipeline:
+    """
+    Runs items through a chain of stages, each with its own worker
+    threads, connected by bounded queues. A slow stage fills its input
+    queue and blocks the one before it, so at most STAGE_QUEUE_SIZE items
+    wait between two stages however many items go in, while network
+    waits in one stage overlap with work in the others. An exception in
+    a stage drops that item only.
+
+    Parameters:
+    stages (list): Stage objects, in order
+    queue_size (int): Capacity of each queue, defaults to STAGE_QUEUE_SIZE
+    """
+
+    def __init__(self, stages: list, queue_size: int = None):
+        self.stages = stages
+        self.queue_size = queue_size or STAGE_QUEUE_SIZE
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def _count(self, stage: Stage, key: str, n: int = 1):
+        with self.lock:
+            self.stats[stage.name][key] += n
+
+    def _call(self, stage: Stage, payload, size: int, outbox):
+        try:
+            result = stage.fn(payload)
+        except Exception as e:
+            logger.error(f"Stage {stage.name} failed: {e}")
+            self._count(stage, 'failed', size)
+            return
+
+        if result is None:
+            self._count(stage, 'dropped', size)
+            return
+        self._count(stage, 'passed', size)
+        if outbox is not None:
+            outbox.put(result)
+
+    def _worker(self, stage: Stage, inbox, outbox):
+        if stage.batch_size == 1:
+            while (item := inbox.get()) is not _DONE:
+                self._call(stage, item, 1, outbox)
+            return
+
+        batch, deadline, done = [], None, False
+        while not done:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = inbox.get(timeout=timeout)
+                if item is _DONE:
+                    done = True
+                else:
+                    batch.append(item)
+                    deadline = deadline or time.monotonic() + stage.batch_seconds
+            except queue.Empty:
+                pass
+
+            if batch and (done or len(batch) >= stage.batch_size or time.monotonic() >= deadline):
+                self._call(stage, batch, len(batch), outbox)
+                batch, deadline = [], None
+
+    def run(self, items) -> dict:
+        """
+        Push the items through every stage and wait until all are done
+
+        Parameters:
+        items (iterable): Inputs of the first stage, consumed lazily
+
+        Returns:
+        dict: Items passed, dropped and failed per stage
+        """
+        self.stats = {stage.name: {'passed': 0, 'dropped': 0, 'failed': 0} for stage in self.stages}
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        workers = []
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            threads = [
+                threading.Thread(target=self._worker, args=(stage, queues[i], outbox), daemon=True)
+                for _ in range(stage.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            workers.append(threads)
+
+        for item in items:
+            queues[0].put(item)
+
+        # Close each stage once the one before it has finished
+        for i, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                queues[i].put(_DONE)
+            for thread in workers[i]:
+                thread.join()
+
+        return self.stats
@@ -1,6 +1,8 @@
 import streamlit as st
 import pandas as pd
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+from data_access import compact_table, to_frame, memory_footprint
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -21,20 +23,27 @@ except Exception as e:
 
 
 # --- Caching Data Loading Function ---
-@st.cache_data(ttl=900)
-def run_query(query: str) -> pd.DataFrame:
-    """Runs a BigQuery query and returns the results as a Pandas DataFrame."""
+# Cached as a shared resource: every session reads the same compact frame
+# instead of receiving its own copy. The frame is an ordinary writable
+# pandas object, so only filter or copy it, never modify it in place.
+@st.cache_resource(ttl=900)
+def run_query(query: str, optional: bool = False) -> pd.DataFrame:
+    """Runs a BigQuery query and returns the results as a compact Pandas DataFrame.
+    With optional=True a missing table is read as empty instead of reported as an error."""
     try:
-        df = client.query(query).to_dataframe()
+        df = to_frame(compact_table(client.query(query).to_arrow()))
         return df
     except Exception as e:
-        st.error(f"An error occurred while running the query: {e}")
+        if not (optional and isinstance(e, NotFound)):
+            st.error(f"An error occurred while running the query: {e}")
         return pd.DataFrame()
 
 # --- Load Data from dbt Marts ---
 df_latest_weather = run_query("SELECT * FROM `weather-data-etl-464123.weather_marts.dim_weather_latest`")
 df_forecasts = run_query("SELECT * FROM `weather-data-etl-464123.weather_data.weather_forecasts`")
 df_accuracy = run_query("SELECT * FROM `weather-data-etl-464123.weather_marts.fact_forecast_accuracy` ORDER BY forecast_for_date")
+# Running error statistics kept up to date by the ETL's accuracy engine, missing until it first publishes
+df_accuracy_stats = run_query("SELECT * FROM `weather-data-etl-464123.weather_data.forecast_accuracy_stats` ORDER BY lead_days", optional=True)
 
 if df_latest_weather.empty:
     st.error("Could not load latest weather data. Please check if the dbt models have run successfully.")
@@ -53,6 +62,7 @@ selected_city = st.sidebar.selectbox(
 city_weather = df_latest_weather[df_latest_weather['city'] == selected_city].iloc[0]
 city_forecasts = df_forecasts[df_forecasts['city'] == selected_city]
 city_accuracy = df_accuracy[df_accuracy['city'] == selected_city]
+city_accuracy_stats = df_accuracy_stats[df_accuracy_stats['city'] == selected_city] if not df_accuracy_stats.empty else df_accuracy_stats
 
 
 # --- Main Dashboard ---
@@ -105,9 +115,18 @@ with tab3:
 
         st.line_chart(accuracy_chart_data)
 
-        # Calculate and display Mean Absolute Error (MAE)
-        mae = abs(city_accuracy['temp_error_celsius']).mean()
-        st.metric("Mean Absolute Error (MAE)", f"{mae:.2f} °C", help="The average absolute difference between the predicted and actual temperature.")
+        if not city_accuracy_stats.empty:
+            # Error statistics per source and lead time, maintained incrementally by the ETL
+            for _, stats in city_accuracy_stats.iterrows():
+                st.caption(f"{stats['source']} forecasts made {stats['lead_days']} days ahead ({stats['n']} days scored)")
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Mean Absolute Error (MAE)", f"{stats['mae']:.2f} °C", help="The average absolute difference between the predicted and actual temperature.")
+                col2.metric("Root Mean Squared Error (RMSE)", f"{stats['rmse']:.2f} °C", help="Like MAE, but penalizes large misses more.")
+                col3.metric("Bias", f"{stats['bias']:+.2f} °C", help="Average of predicted minus actual: positive means forecasts run warm.")
+        else:
+            # Calculate and display Mean Absolute Error (MAE)
+            mae = abs(city_accuracy['temp_error_celsius']).mean()
+            st.metric("Mean Absolute Error (MAE)", f"{mae:.2f} °C", help="The average absolute difference between the predicted and actual temperature.")
         
         st.write("Accuracy Details:")
         st.dataframe(city_accuracy[['forecast_for_date', 'Predicted', 'Actual', 'temp_error_celsius']])
@@ -116,6 +135,10 @@ with tab3:
 
 # --- About Section in Sidebar ---
 st.sidebar.markdown("---")
+st.sidebar.caption(
+    f"Cached data in memory: latest {memory_footprint(df_latest_weather)}, "
+    f"forecasts {memory_footprint(df_forecasts)}, accuracy {memory_footprint(df_accuracy)}"
+)
 st.sidebar.info(
     """
     This dashboard is the final product of a complete ETL/ELT data pipeline built on Google Cloud Platform using only free-tier services.
@@ -0,0 +1,60 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pandas as pd
+
+OPENWEATHER_ICON_PREFIX = 'https://openweathermap.org/img/wn/'
+OPENWEATHER_ICON_SUFFIX = '@2x.png'
+
+# Text columns repeating fewer distinct values than this share of rows get dictionary-encoded
+DICTIONARY_MAX_RATIO = 0.5
+
+def icon_url(icon: str) -> str:
+    """Rebuild the icon URL from the code kept by compact_table"""
+    if icon is None or pd.isna(icon):
+        return None
+    if icon.startswith(('http:', 'https:', '//')):
+        return icon
+    return f"{OPENWEATHER_ICON_PREFIX}{icon}{OPENWEATHER_ICON_SUFFIX}"
+
+def compact_table(table: pa.Table) -> pa.Table:
+    """
+    Shrink a query result while it is still in Arrow: icon_url becomes
+    the short icon code, repeated strings are dictionary-encoded (they
+    arrive in pandas as categoricals), NUMERIC decimals and doubles
+    become float32 and integers shrink to int32 when they fit.
+    """
+    if 'icon_url' in table.column_names:
+        icon = pc.replace_substring_regex(
+            table['icon_url'],
+            pattern=f"^{OPENWEATHER_ICON_PREFIX.replace('.', '[.]')}(.*){OPENWEATHER_ICON_SUFFIX.replace('.', '[.]')}$",
+            replacement=r'\1'
+        )
+        table = table.drop_columns(['icon_url']).append_column('icon', icon)
+
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        kind = column.type
+        if pa.types.is_string(kind) or pa.types.is_large_string(kind):
+            if pc.count_distinct(column).as_py() <= DICTIONARY_MAX_RATIO * len(column):
+                column = pc.dictionary_encode(column)
+        elif pa.types.is_decimal(kind) or pa.types.is_float64(kind):
+            column = column.cast(pa.float32())
+        elif pa.types.is_int64(kind) and len(column) and column.null_count < len(column):
+            bounds = pc.min_max(column).as_py()
+            if -2 ** 31 <= bounds['min'] and bounds['max'] < 2 ** 31:
+                column = column.cast(pa.int32())
+        columns.append(column)
+
+    return pa.table(columns, names=table.column_names)
+
+def to_frame(table: pa.Table) -> pd.DataFrame:
+    """
+    Convert a compacted table, releasing the Arrow buffers as columns are
+    converted. The result holds NumPy-backed columns and categoricals,
+    not Arrow memory, and is writable like any other DataFrame.
+    """
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def memory_footprint(df: pd.DataFrame) -> str:
+    """Human readable memory used by a DataFrame, including string contents"""
+    return f"{df.memory_usage(deep=True).sum() / 1024 ** 2:.2f} MB"
@@ -1,36 +1,76 @@
-from datetime import datetime
-from airflow import DAG
-from airflow.operators.docker_operator import DockerOperator
+import os
+import sys
+from datetime import datetime, timedelta
+from airflow.decorators import dag, task
+from airflow.exceptions import AirflowException
+from airflow.models import Variable
+
+# The ETL code is baked into the Airflow image (see airflow.Dockerfile),
+# so tasks run inside the long-lived workers instead of a new container
+sys.path.insert(0, os.getenv('WEATHER_ETL_SRC', '/opt/airflow/src'))
+
+# Number of city shards, each one becomes a mapped task instance
+SHARD_COUNT = int(os.getenv('WEATHER_SHARD_COUNT', '4'))
 
 default_args = {
     'owner': 'airflow',
     'depends_on_past': False,
     'start_date': datetime(2025, 2, 3),
-    'retries': 1,
+    'retries': 2,
+    'retry_delay': timedelta(minutes=2),
 }
 
-dag = DAG(
+@dag(
     'weather_etl_pipeline',
     default_args=default_args,
-    schedule_interval='@hourly',  # Run every hour
+    schedule='@hourly',  # Run every hour
     catchup=False,
 )
+def weather_etl_pipeline():
 
-etl_task = DockerOperator(
-    task_id='run_etl_pipeline',
-    image='etl-pipeline:latest',  # Use your ETL image name
-    api_version='auto',
-    auto_remove=True,
-    docker_url='unix://var/run/docker.sock',
-    network_mode='weather_network',  # Use your Docker network
-    environment={
-        'API_KEY': '{{ var.value.API_KEY }}',  # Store securely in Airflow Variables
-        'DB_HOST': 'postgres',
-        'DB_NAME': '{{ var.value.DB_NAME }}',
-        'DB_USER': '{{ var.value.DB_USER }}',
-        'DB_PASS': '{{ var.value.DB_PASS }}',
-    },
-    dag=dag,
-)
+    @task
+    def list_shards() -> list:
+        return [f'{index}/{SHARD_COUNT}' for index in range(SHARD_COUNT)]
+
+    @task
+    def init_table():
+        from pipeline import init_bigquery_table
+        init_bigquery_table()
+
+    @task
+    def extract(shard: str) -> dict:
+        from main import extract_shard
+        api_key = Variable.get('API_KEY')
+        result = extract_shard(shard, api_key)
+
+        # Retry only the cities that failed, the good rows are kept either way
+        if result['failed']:
+            retried = extract_shard(api_key=api_key, cities=result['failed'])
+            result = {'rows': result['rows'] + retried['rows'], 'failed': retried['failed']}
+
+        return result
+
+    @task
+    def load(result: dict):
+        from change_filter import ChangeFilter
+        from pipeline import load_weather_rows_to_bigquery
+
+        change_filter = ChangeFilter()
+        rows = change_filter.filter(result['rows'])
+        if not load_weather_rows_to_bigquery(rows):
+            raise AirflowException(f'Failed to load {len(rows)} rows to BigQuery')
+
+        change_filter.remember(rows)
+        return change_filter.stats
+
+    # Flags the run without holding back the rows of the other cities
+    @task(retries=0)
+    def check_failed(result: dict):
+        if result['failed']:
+            raise AirflowException(f"Could not extract: {', '.join(result['failed'])}")
+
+    results = extract.expand(shard=list_shards())
+    init_table() >> load.expand(result=results)
+    check_failed.expand(result=results)
 
-etl_task
\ No newline at end of file
+weather_etl_pipeline()
@@ -0,0 +1,308 @@
+import os
+import math
+import sqlite3
+import uuid
+from datetime import date, datetime, timedelta
+from google.cloud import bigquery
+from utils_log import log_decorator
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv(override=True)
+
+# Environment variables
+GCP_PROJECT = os.getenv('GCP_PROJECT')
+DATASET_ID = os.getenv('DATASET_ID')
+FORECASTS_TABLE_ID = os.getenv('FORECASTS_TABLE_ID', 'weather_forecasts')
+ACCURACY_TABLE_ID = os.getenv('ACCURACY_TABLE_ID', 'forecast_accuracy_stats')
+# Keep it on a persistent volume: the running sums cannot be rebuilt from scored forecasts
+ACCURACY_DB = os.getenv('ACCURACY_DB', os.path.join('state', 'forecast_accuracy.db'))
+# Forecasts for days this far in the past are dropped, scored or not (e.g. a city that stopped reporting)
+FORECAST_RETENTION_DAYS = int(os.getenv('FORECAST_RETENTION_DAYS', '3'))
+# Each sync re-reads this much before the watermark to catch forecasts inserted late
+FORECAST_SYNC_OVERLAP_HOURS = int(os.getenv('FORECAST_SYNC_OVERLAP_HOURS', '6'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS forecasts (
+    city TEXT NOT NULL,
+    source TEXT NOT NULL,
+    forecast_for_date TEXT NOT NULL,
+    lead_days INTEGER NOT NULL,
+    predicted_temp REAL NOT NULL,
+    PRIMARY KEY (city, source, forecast_for_date, lead_days)
+);
+CREATE TABLE IF NOT EXISTS daily_observations (
+    city TEXT NOT NULL,
+    date TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    temp_sum REAL NOT NULL,
+    closed INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (city, date)
+);
+CREATE TABLE IF NOT EXISTS error_stats (
+    city TEXT NOT NULL,
+    source TEXT NOT NULL,
+    lead_days INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    sum_error REAL NOT NULL,
+    sum_abs_error REAL NOT NULL,
+    sum_sq_error REAL NOT NULL,
+    PRIMARY KEY (city, source, lead_days)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+class AccuracyEngine:
+    '''
+    Forecast accuracy maintained incrementally as observations arrive,
+    instead of rebuilding the forecast/actual join over all history.
+
+    Only forecasts for the catalog cities being observed are kept, until
+    the day they predict is scored or is FORECAST_RETENTION_DAYS old.
+    Observations only update a running mean temperature per city and
+    day; when a reading for a later day arrives, the finished day is
+    joined with its forecasts and each error updates running sums per
+    city, source and lead time, from which MAE, RMSE and bias are
+    derived. Every update is O(1) per row, and the state is a small
+    SQLite file: stats grow with cities x sources x lead times, and
+    joined or expired forecasts are deleted.
+
+    Parameters:
+    path (str): SQLite file holding the engine state
+    '''
+
+    def __init__(self, path: str = None):
+        # May be used from pipeline worker threads; callers serialize access
+        path = path or ACCURACY_DB
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    @log_decorator
+    def record_forecasts(self, rows: list, cities: list = None) -> int:
+        '''
+        Store forecasts until the day they predict can be scored.
+        Forecasts for days already scored are skipped, so forecasts read
+        again are idempotent.
+
+        Parameters:
+        rows (list): Rows of the weather_forecasts table
+        cities (list): Catalog names of the cities to keep, None for all
+
+        Returns:
+        int: Number of forecasts stored
+        '''
+        cities = set(cities) if cities is not None else None
+        cutoff = date.today() - timedelta(days=FORECAST_RETENTION_DAYS)
+        records = []
+        for row in rows:
+            if cities is not None and row['city'] not in cities:
+                continue
+            made_at = row['forecast_made_at']
+            made_at = made_at if isinstance(made_at, datetime) else datetime.fromisoformat(str(made_at))
+            for_date = row['forecast_for_date']
+            for_date = for_date if isinstance(for_date, date) else date.fromisoformat(str(for_date))
+            if for_date < cutoff:
+                continue
+            records.append((
+                row['city'],
+                row['source'],
+                for_date.isoformat(),
+                (for_date - made_at.date()).days,
+                float(row['predicted_temp']),
+            ))
+
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO forecasts SELECT ?1, ?2, ?3, ?4, ?5
+                WHERE NOT EXISTS (SELECT 1 FROM daily_observations WHERE city = ?1 AND date = ?3 AND closed = 1)
+            ''', records)
+            stored = self.conn.total_changes - before
+            self.conn.execute('DELETE FROM forecasts WHERE forecast_for_date < ?', (cutoff.isoformat(),))
+        return stored
+
+    @log_decorator
+    def record_observations(self, rows: list) -> int:
+        '''
+        Add observations to their day's running mean and score the days
+        that are over
+
+        Parameters:
+        rows (list): Transformed weather rows
+
+        Returns:
+        int: Number of days scored
+        '''
+        scored = 0
+        with self.conn:
+            for row in rows:
+                day = str(row['timestamp'])[:10]
+                self.conn.execute('''
+                    INSERT INTO daily_observations (city, date, n, temp_sum) VALUES (?, ?, 1, ?)
+                    ON CONFLICT (city, date) DO UPDATE SET n = n + 1, temp_sum = temp_sum + excluded.temp_sum
+                    WHERE closed = 0
+                ''', (row['city'], day, float(row['temperature'])))
+
+                finished = self.conn.execute(
+                    'SELECT date, temp_sum / n FROM daily_observations WHERE city = ? AND date < ? AND closed = 0',
+                    (row['city'], day)
+                ).fetchall()
+                for finished_day, actual in finished:
+                    self._score_day(row['city'], finished_day, actual)
+                    scored += 1
+        return scored
+
+    def _score_day(self, city: str, day: str, actual: float):
+        forecasts = self.conn.execute(
+            'SELECT source, lead_days, predicted_temp FROM forecasts WHERE city = ? AND forecast_for_date = ?',
+            (city, day)
+        ).fetchall()
+
+        for source, lead_days, predicted in forecasts:
+            error = predicted - actual
+            self.conn.execute('''
+                INSERT INTO error_stats VALUES (?, ?, ?, 1, ?, ?, ?)
+                ON CONFLICT (city, source, lead_days) DO UPDATE SET
+                    n = n + 1,
+                    sum_error = sum_error + excluded.sum_error,
+                    sum_abs_error = sum_abs_error + excluded.sum_abs_error,
+                    sum_sq_error = sum_sq_error + excluded.sum_sq_error
+            ''', (city, source, lead_days, error, abs(error), error * error))
+
+        self.conn.execute('DELETE FROM forecasts WHERE city = ? AND forecast_for_date = ?', (city, day))
+        self.conn.execute('UPDATE daily_observations SET closed = 1 WHERE city = ? AND date = ?', (city, day))
+        # Closed days are only kept a week, to ignore late readings of already scored days
+        self.conn.execute(
+            "DELETE FROM daily_observations WHERE city = ? AND closed = 1 AND date < date(?, '-7 days')",
+            (city, day)
+        )
+
+    def stats(self) -> list:
+        '''
+        Accuracy per city, source and lead time
+
+        Returns:
+        list: Dicts with n, mae, rmse and bias (predicted minus actual)
+        '''
+        rows = self.conn.execute(
+            'SELECT city, source, lead_days, n, sum_error, sum_abs_error, sum_sq_error FROM error_stats ORDER BY city, source, lead_days'
+        ).fetchall()
+        return [
+            {
+                'city': city,
+                'source': source,
+                'lead_days': lead_days,
+                'n': n,
+                'mae': round(sum_abs_error / n, 3),
+                'rmse': round(math.sqrt(sum_sq_error / n), 3),
+                'bias': round(sum_error / n, 3),
+            }
+            for city, source, lead_days, n, sum_error, sum_abs_error, sum_sq_error in rows
+        ]
+
+    @log_decorator
+    def sync_forecasts(self, cities: list = None) -> int:
+        '''
+        Pull the forecasts made since the last sync from BigQuery. The
+        read starts FORECAST_SYNC_OVERLAP_HOURS before the watermark, as
+        a forecast can be inserted after a newer one was already synced.
+
+        Parameters:
+        cities (list): Catalog names of the cities to keep, None for all
+
+        Returns:
+        int: Number of forecasts read
+        '''
+        watermark = self.conn.execute("SELECT value FROM watermarks WHERE name = 'forecast_made_at'").fetchone()
+        watermark = datetime.fromisoformat(watermark[0]) if watermark else datetime(1970, 1, 1)
+        start = max(watermark - timedelta(hours=FORECAST_SYNC_OVERLAP_HOURS), datetime(1970, 1, 1))
+        client = bigquery.Client(project=GCP_PROJECT)
+
+        query = f'''
+        SELECT city, source, forecast_made_at, forecast_for_date, predicted_temp
+        FROM `{GCP_PROJECT}.{DATASET_ID}.{FORECASTS_TABLE_ID}`
+        WHERE CAST(forecast_made_at AS DATETIME) > CAST(@start AS DATETIME)
+          AND (@all_cities OR city IN UNNEST(@cities))
+        ORDER BY forecast_made_at
+        '''
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter('start', 'STRING', start.isoformat()),
+            bigquery.ScalarQueryParameter('all_cities', 'BOOL', cities is None),
+            bigquery.ArrayQueryParameter('cities', 'STRING', list(cities or [])),
+        ])
+        try:
+            rows = [dict(row) for row in client.query(query, job_config=job_config).result()]
+        except Exception as e:
+            print(f'Error while fetching new forecasts: {e}')
+            return 0
+
+        if not rows:
+            return 0
+
+        self.record_forecasts(rows, cities)
+        latest = rows[-1]['forecast_made_at']
+        latest = latest if isinstance(latest, datetime) else datetime.fromisoformat(str(latest))
+        # Rows from the overlap alone must not move the watermark back
+        latest = max(latest.replace(tzinfo=None), watermark)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO watermarks VALUES ('forecast_made_at', ?)", (latest.isoformat(),))
+        return len(rows)
+
+    @log_decorator
+    def publish_stats(self) -> bool:
+        '''
+        Merge the current stats into the accuracy table in BigQuery.
+        Rows are upserted by city, source and lead time, so processes
+        scoring different cities never erase each other's stats.
+        '''
+        client = bigquery.Client(project=GCP_PROJECT)
+        table_id = f'{GCP_PROJECT}.{DATASET_ID}.{ACCURACY_TABLE_ID}'
+        staging_id = f'{table_id}_staging_{uuid.uuid4().hex}'
+        schema = [
+            bigquery.SchemaField('city', 'STRING'),
+            bigquery.SchemaField('source', 'STRING'),
+            bigquery.SchemaField('lead_days', 'INTEGER'),
+            bigquery.SchemaField('n', 'INTEGER'),
+            bigquery.SchemaField('mae', 'FLOAT'),
+            bigquery.SchemaField('rmse', 'FLOAT'),
+            bigquery.SchemaField('bias', 'FLOAT'),
+        ]
+
+        stats = self.stats()
+        if not stats:
+            return True
+
+        try:
+            client.create_table(bigquery.Table(table_id, schema=schema), exists_ok=True)
+            client.load_table_from_json(
+                stats, staging_id, job_config=bigquery.LoadJobConfig(schema=schema)
+            ).result()
+            client.query(f'''
+                MERGE `{table_id}` T
+                USING `{staging_id}` S
+                ON T.city = S.city AND T.source = S.source AND T.lead_days = S.lead_days
+                WHEN MATCHED THEN UPDATE SET n = S.n, mae = S.mae, rmse = S.rmse, bias = S.bias
+                WHEN NOT MATCHED THEN INSERT ROW
+            ''').result()
+            print(f'Published forecast accuracy to {table_id}')
+            return True
+        except Exception as e:
+            print(f'Error while publishing forecast accuracy: {e}')
+            return False
+        finally:
+            client.delete_table(staging_id, not_found_ok=True)
+
+if __name__ == '__main__':
+    engine = AccuracyEngine()
+    engine.sync_forecasts()
+    engine.publish_stats()
+    engine.close()
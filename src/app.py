@@ -1,9 +1,14 @@
 import os
 import streamlit as st
+import threading
 import folium
+from folium.plugins import HeatMap
 from streamlit_folium import st_folium
+import numpy as np
 import pandas as pd
 import psycopg2
+from spatial import StationIndex
+from data_access import compact_frame, icon_url, memory_footprint
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -18,16 +23,16 @@ DB_CONFIG = {
     "port": "5432" 
 }
 
-@st.cache_data(ttl=60)
-def get_data(city=None):
-    """Fetch data from PostgreSQL with caching"""
+# Cached as shared resources: every session reads the same compact frame
+# instead of receiving its own copy. The frames are ordinary writable
+# pandas objects, so only filter or copy them, never modify them in place.
+@st.cache_resource(ttl=60)
+def get_data():
+    """Fetch all data from PostgreSQL, compacted for the dashboard"""
     try:
         conn = psycopg2.connect(**DB_CONFIG)
         query = "SELECT * FROM weather_capitals"  # Match your table name
-        if city and city != 'All':
-            query += f" WHERE city = '{city}'"
-        df = pd.read_sql(query, conn)
-        return df
+        return compact_frame(pd.read_sql(query, conn))
     except Exception as e:
         st.error(f"Database error: {e}")
         return pd.DataFrame()
@@ -35,7 +40,7 @@ def get_data(city=None):
         if 'conn' in locals():
             conn.close()
 
-@st.cache_data(ttl=60)
+@st.cache_resource(ttl=60)
 def get_latest_weather():
     """Get latest weather entry for each city"""
     try:
@@ -48,7 +53,7 @@ def get_latest_weather():
             )
             SELECT * FROM latest_data WHERE rn = 1
         """
-        return pd.read_sql(query, conn)
+        return compact_frame(pd.read_sql(query, conn))
     except Exception as e:
         st.error(f"Database error: {e}")
         return pd.DataFrame()
@@ -56,6 +61,18 @@ def get_latest_weather():
         if 'conn' in locals():
             conn.close()
 
+@st.cache_resource
+def get_station_index():
+    """Spatial index shared by every session, updated with the latest readings"""
+    return StationIndex(), threading.Lock()
+
+def get_temperature_grid(latest: pd.DataFrame, step: float = 0.5) -> dict:
+    """Interpolate the temperature over Brazil from the latest reading per city"""
+    station_index, lock = get_station_index()
+    with lock:
+        station_index.update(latest[['city', 'latitude', 'longitude', 'temperature', 'humidity']].to_dict('records'))
+        return station_index.grid(step=step)
+
 # Main app
 st.title("Weather Dashboard 🌦️")
 
@@ -67,10 +84,12 @@ selected_city = st.sidebar.selectbox("Select City", cities)
 
 # Refresh button
 if st.sidebar.button("Refresh Data"):
-    st.cache_data.clear()
+    get_data.clear()
+    get_latest_weather.clear()
 
-# Get filtered data
-df_filtered = get_data(selected_city if selected_city != 'All' else None)
+# Filter the shared frame instead of caching one frame per city
+df_filtered = df if selected_city == 'All' else df[df['city'] == selected_city]
+st.sidebar.caption(f"Cached data in memory: {memory_footprint(df)}")
 
 # Show raw data
 if st.checkbox("Show Raw Data"):
@@ -112,12 +131,28 @@ if not map_data.empty:
             location=[row['latitude'], row['longitude']],
             popup=folium.Popup(popup_html, max_width=200),
             icon=folium.features.CustomIcon(
-                row['icon_url'],
+                icon_url(row['icon']),
                 icon_size=(40, 40),
                 icon_anchor=(20, 20)
             )
         ).add_to(m)
 
+    # Interpolated temperature layer, scaled to the current min/max
+    grid = get_temperature_grid(map_data)
+    temperature = grid['temperature']
+    valid = ~np.isnan(temperature)
+    if valid.any():
+        span = max(np.ptp(temperature[valid]), 1e-6)
+        intensity = (temperature[valid] - temperature[valid].min()) / span
+        HeatMap(
+            np.column_stack((grid['latitude'][valid], grid['longitude'][valid], intensity)).tolist(),
+            name="Interpolated temperature",
+            radius=18,
+            blur=24,
+            min_opacity=0.2
+        ).add_to(m)
+        folium.LayerControl().add_to(m)
+
     # Display the map in Streamlit
     st_folium(m, use_container_width=True)
 
@@ -126,7 +161,7 @@ st.subheader("Weather Conditions")
 if not df_filtered.empty:
     col1, col2 = st.columns(2)
     with col1:
-        st.bar_chart(df_filtered['description'].value_counts())
+        st.bar_chart(df_filtered['description'].value_counts().loc[lambda counts: counts > 0])
     with col2:
         st.write("Wind Speed Distribution")
         st.area_chart(df_filtered['wind_speed'])
@@ -0,0 +1,137 @@
+import os
+import sqlite3
+import hashlib
+import tempfile
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv(override=True)
+
+# Environment variables
+CHANGE_FILTER_DB = os.getenv('CHANGE_FILTER_DB', os.path.join(tempfile.gettempdir(), 'weather_last_seen.db'))
+# Measurements are snapped to a grid of these steps, readings in the same cell count as repeats (0 means exact)
+TEMPERATURE_TOLERANCE = float(os.getenv('TEMPERATURE_TOLERANCE', '0'))
+HUMIDITY_TOLERANCE = float(os.getenv('HUMIDITY_TOLERANCE', '0'))
+# A reading this much newer than the last one loaded is always loaded, so stable weather never goes stale
+CHANGE_FILTER_MAX_AGE = int(os.getenv('CHANGE_FILTER_MAX_AGE', '3600'))
+
+def quantize(value, step: float):
+    if value is None or not step:
+        return value
+    return round(float(value) / step)
+
+def parse_timestamp(value) -> datetime:
+    value = value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+    return value.replace(tzinfo=None)
+
+class ChangeFilter:
+    '''
+    Drop observations that repeat the last one loaded for the same city.
+    Each row is reduced to an 8-byte fingerprint of its timestamp,
+    temperature, humidity and description, kept in memory and in a
+    SQLite file so it survives restarts and is shared by the workers.
+    When a tolerance is set, the measurements are snapped to a grid of
+    that step and the timestamp is left out, so newer readings in the
+    same grid cell as the last one loaded count as repeats (two close
+    readings on either side of a cell boundary still count as changed).
+    A reading CHANGE_FILTER_MAX_AGE seconds newer than the last one
+    loaded always passes, so a city with stable weather is still
+    refreshed.
+
+    filter() only checks; call remember() once the rows are loaded, so a
+    failed load never hides an observation from the next run.
+
+    Parameters:
+    path (str): SQLite file with the last fingerprint and timestamp per city
+    '''
+
+    def __init__(self, path: str = None):
+        self.path = path or CHANGE_FILTER_DB
+        self.stats = {'passed': 0, 'suppressed': 0}
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS last_seen (city TEXT PRIMARY KEY, fingerprint BLOB NOT NULL, timestamp TEXT)')
+                # Files created before the timestamp was kept
+                if 'timestamp' not in [column[1] for column in conn.execute('PRAGMA table_info(last_seen)')]:
+                    conn.execute('ALTER TABLE last_seen ADD COLUMN timestamp TEXT')
+            self.last_seen = {
+                city: (fingerprint, timestamp)
+                for city, fingerprint, timestamp in conn.execute('SELECT city, fingerprint, timestamp FROM last_seen')
+            }
+        finally:
+            conn.close()
+
+    @staticmethod
+    def fingerprint(row: dict) -> bytes:
+        normalized = (
+            quantize(row['temperature'], TEMPERATURE_TOLERANCE),
+            quantize(row['humidity'], HUMIDITY_TOLERANCE),
+            row['description'],
+        )
+        # The same timestamp is the same reading, so tolerances only matter across timestamps
+        if not (TEMPERATURE_TOLERANCE or HUMIDITY_TOLERANCE):
+            normalized = (row['timestamp'],) + normalized
+        return hashlib.blake2b(repr(normalized).encode('utf-8'), digest_size=8).digest()
+
+    @staticmethod
+    def is_repeat(row: dict, fingerprint: bytes, seen: tuple) -> bool:
+        if seen is None or fingerprint != seen[0]:
+            return False
+        if seen[1] is None:
+            return True
+        age = (parse_timestamp(row['timestamp']) - parse_timestamp(seen[1])).total_seconds()
+        return age < CHANGE_FILTER_MAX_AGE
+
+    def filter(self, rows: list) -> list:
+        '''
+        Keep only the rows that changed since the last loaded observation
+
+        Parameters:
+        rows (list): Transformed weather rows
+
+        Returns:
+        list: Rows worth loading
+        '''
+        changed, pending = [], {}
+
+        for row in rows:
+            fingerprint = self.fingerprint(row)
+            if self.is_repeat(row, fingerprint, pending.get(row['city']) or self.last_seen.get(row['city'])):
+                self.stats['suppressed'] += 1
+                continue
+
+            pending[row['city']] = (fingerprint, str(row['timestamp']))
+            changed.append(row)
+            self.stats['passed'] += 1
+
+        return changed
+
+    def remember(self, rows: list):
+        '''
+        Record the rows that were loaded as the last seen per city. Rows
+        older than the entry already kept for their city (replayed spool
+        segments, for one) are skipped so they never replace a newer one.
+        '''
+        fingerprints = {}
+        for row in rows:
+            seen = fingerprints.get(row['city']) or self.last_seen.get(row['city'])
+            if seen and seen[1] is not None and parse_timestamp(row['timestamp']) < parse_timestamp(seen[1]):
+                continue
+            fingerprints[row['city']] = (self.fingerprint(row), str(row['timestamp']))
+        if not fingerprints:
+            return
+
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO last_seen (city, fingerprint, timestamp) VALUES (?, ?, ?)',
+                    [(city, fingerprint, timestamp) for city, (fingerprint, timestamp) in fingerprints.items()]
+                )
+        finally:
+            conn.close()
+
+        self.last_seen.update(fingerprints)
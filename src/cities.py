@@ -0,0 +1,72 @@
+import csv
+import os
+import zlib
+from utils_log import log_decorator
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv(override=True)
+
+# Environment variables
+CITIES_FILE = os.getenv('CITIES_FILE', os.path.join(os.path.dirname(__file__), 'cities.csv'))
+
+def parse_shard(shard: str) -> tuple:
+    '''
+    Parse a shard specification in the form "i/n"
+
+    Parameters:
+    shard (str): Shard index and total number of shards, e.g. "0/4"
+
+    Returns:
+    tuple: (index, count) with 0 <= index < count
+    '''
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'Invalid shard "{shard}", expected the form i/n')
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Invalid shard "{shard}", index must be in [0, {count})')
+
+    return index, count
+
+def shard_of(query: str, count: int) -> int:
+    '''
+    Deterministic shard of a city. It depends only on the city query,
+    so growing the catalog never moves existing cities between shards
+    '''
+    return zlib.crc32(query.encode('utf-8')) % count
+
+@log_decorator
+def load_cities(path: str = None, shard: str = None) -> list:
+    '''
+    Read the city catalog and keep only the cities of the chosen shard
+
+    Parameters:
+    path (str): CSV catalog with the columns city, state and query
+    shard (str): Optional shard specification in the form "i/n"
+
+    Returns:
+    list: City queries to send to the weather API
+    '''
+    with open(path or CITIES_FILE, 'r', encoding='utf-8', newline='') as f:
+        cities = [row['query'] or row['city'] for row in csv.DictReader(f)]
+
+    if shard:
+        index, count = parse_shard(shard)
+        cities = [city for city in cities if shard_of(city, count) == index]
+
+    return cities
+
+def catalog_names(path: str = None) -> dict:
+    '''
+    Catalog city name of every query, e.g. {"Salvador,BA,BR": "Salvador"}
+
+    Parameters:
+    path (str): CSV catalog with the columns city, state and query
+
+    Returns:
+    dict: City name per query
+    '''
+    with open(path or CITIES_FILE, 'r', encoding='utf-8', newline='') as f:
+        return {row['query'] or row['city']: row['city'] for row in csv.DictReader(f)}
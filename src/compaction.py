@@ -0,0 +1,269 @@
+import os
+import argparse
+import psycopg2
+from datetime import datetime, timedelta, timezone
+from google.cloud import bigquery
+from utils_log import log_decorator
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv(override=True)
+
+# Environment variables
+DB_HOST = os.getenv('DB_HOST')
+DB_NAME = os.getenv('DB_NAME')
+DB_USER = os.getenv('DB_USER')
+DB_PASS = os.getenv('DB_PASS')
+GCP_PROJECT = os.getenv('GCP_PROJECT')
+DATASET_ID = os.getenv('DATASET_ID')
+TABLE_ID = os.getenv('TABLE_ID')
+
+# Raw rows are kept this long, then rolled into hourly aggregates
+RAW_RETENTION_DAYS = int(os.getenv('RAW_RETENTION_DAYS', '7'))
+# Raw rows kept in BigQuery; unset keeps them all, see compact_bigquery
+BIGQUERY_RAW_RETENTION_DAYS = os.getenv('BIGQUERY_RAW_RETENTION_DAYS')
+# Hourly aggregates are kept this long, then rolled into daily aggregates
+HOURLY_RETENTION_DAYS = int(os.getenv('HOURLY_RETENTION_DAYS', '90'))
+# Arbitrary key so only one compactor runs at a time on a Postgres database
+COMPACTION_LOCK_KEY = 8_150_219
+
+# --- Postgres ---
+
+# The DELETE ... RETURNING feeds the INSERT, so exactly the rows removed are
+# aggregated, even when rows are committed into the window meanwhile
+POSTGRES_HOURLY_SQL = '''
+    WITH moved AS (
+        DELETE FROM weather_capitals
+        WHERE timestamp >= %(start)s AND timestamp < %(end)s
+        RETURNING city, timestamp, temperature, feels_like_temp, humidity, wind_speed, description, longitude, latitude
+    )
+    INSERT INTO weather_capitals_hourly AS h
+        (city, hour, n, temperature, temperature_min, temperature_max,
+         feels_like_temp, humidity, wind_speed, description, longitude, latitude)
+    SELECT city, date_trunc('hour', timestamp), COUNT(*),
+           AVG(temperature), MIN(temperature), MAX(temperature),
+           AVG(feels_like_temp), AVG(humidity), AVG(wind_speed),
+           MODE() WITHIN GROUP (ORDER BY description), AVG(longitude), AVG(latitude)
+    FROM moved
+    GROUP BY city, date_trunc('hour', timestamp)
+    ON CONFLICT (city, hour) DO UPDATE SET
+        temperature = (h.temperature * h.n + excluded.temperature * excluded.n) / (h.n + excluded.n),
+        temperature_min = LEAST(h.temperature_min, excluded.temperature_min),
+        temperature_max = GREATEST(h.temperature_max, excluded.temperature_max),
+        feels_like_temp = (h.feels_like_temp * h.n + excluded.feels_like_temp * excluded.n) / (h.n + excluded.n),
+        humidity = (h.humidity * h.n + excluded.humidity * excluded.n) / (h.n + excluded.n),
+        wind_speed = (h.wind_speed * h.n + excluded.wind_speed * excluded.n) / (h.n + excluded.n),
+        n = h.n + excluded.n;
+'''
+
+POSTGRES_DAILY_SQL = '''
+    WITH moved AS (
+        DELETE FROM weather_capitals_hourly
+        WHERE hour >= %(start)s AND hour < %(end)s
+        RETURNING *
+    )
+    INSERT INTO weather_capitals_daily AS d
+        (city, day, n, temperature, temperature_min, temperature_max,
+         feels_like_temp, humidity, wind_speed, description, longitude, latitude)
+    SELECT city, hour::date, SUM(n),
+           SUM(temperature * n) / SUM(n), MIN(temperature_min), MAX(temperature_max),
+           SUM(feels_like_temp * n) / SUM(n), SUM(humidity * n) / SUM(n), SUM(wind_speed * n) / SUM(n),
+           MODE() WITHIN GROUP (ORDER BY description), AVG(longitude), AVG(latitude)
+    FROM moved
+    GROUP BY city, hour::date
+    ON CONFLICT (city, day) DO UPDATE SET
+        temperature = (d.temperature * d.n + excluded.temperature * excluded.n) / (d.n + excluded.n),
+        temperature_min = LEAST(d.temperature_min, excluded.temperature_min),
+        temperature_max = GREATEST(d.temperature_max, excluded.temperature_max),
+        feels_like_temp = (d.feels_like_temp * d.n + excluded.feels_like_temp * excluded.n) / (d.n + excluded.n),
+        humidity = (d.humidity * d.n + excluded.humidity * excluded.n) / (d.n + excluded.n),
+        wind_speed = (d.wind_speed * d.n + excluded.wind_speed * excluded.n) / (d.n + excluded.n),
+        n = d.n + excluded.n;
+'''
+
+def database_connection():
+    return psycopg2.connect(
+        host=DB_HOST,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASS
+    )
+
+def compact_postgres_table(conn, table: str, column: str, sql: str, cutoff: datetime, batch: timedelta) -> int:
+    '''
+    Roll the rows of a table older than the cutoff into the next level,
+    one window per transaction, oldest first. Each window deletes its
+    rows and inserts the aggregates of exactly those rows, so the job
+    can stop at any point and resume where it left off. Only rows past
+    the retention window are locked, so loads of new rows never wait.
+
+    Returns:
+    int: Number of windows compacted
+    '''
+    windows = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(f'SELECT MIN({column}) FROM {table} WHERE {column} < %s', (cutoff,))
+            oldest = cur.fetchone()[0]
+        if oldest is None:
+            return windows
+
+        start = datetime.combine(oldest.date() if isinstance(oldest, datetime) else oldest, datetime.min.time())
+        end = min(start + batch, cutoff)
+        with conn, conn.cursor() as cur:
+            cur.execute(sql, {'start': start, 'end': end})
+        print(f'Compacted {table} from {start} to {end}')
+        windows += 1
+
+@log_decorator
+def compact_postgres(batch_days: int = 1):
+    '''Apply the retention policy to the Postgres weather tables'''
+    conn = database_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_try_advisory_lock(%s)', (COMPACTION_LOCK_KEY,))
+            if not cur.fetchone()[0]:
+                print('Another compaction is running, skipping')
+                return
+        conn.commit()
+
+        now = datetime.now()
+        batch = timedelta(days=batch_days)
+        compact_postgres_table(conn, 'weather_capitals', 'timestamp', POSTGRES_HOURLY_SQL,
+                               now - timedelta(days=RAW_RETENTION_DAYS), batch)
+        compact_postgres_table(conn, 'weather_capitals_hourly', 'hour', POSTGRES_DAILY_SQL,
+                               now - timedelta(days=HOURLY_RETENTION_DAYS), batch)
+    finally:
+        conn.close()
+
+# --- BigQuery ---
+
+def bigquery_tables() -> dict:
+    prefix = f'{GCP_PROJECT}.{DATASET_ID}.{TABLE_ID}'
+    return {'raw': prefix, 'hourly': f'{prefix}_hourly', 'daily': f'{prefix}_daily'}
+
+BIGQUERY_SETUP_SQL = '''
+    CREATE TABLE IF NOT EXISTS `{hourly}` (
+        city STRING, hour TIMESTAMP, n INT64,
+        temperature FLOAT64, temperature_min FLOAT64, temperature_max FLOAT64,
+        feels_like_temp FLOAT64, humidity FLOAT64, wind_speed FLOAT64,
+        description STRING, longitude FLOAT64, latitude FLOAT64
+    )
+    PARTITION BY DATE(hour) CLUSTER BY city;
+    CREATE TABLE IF NOT EXISTS `{daily}` (
+        city STRING, day DATE, n INT64,
+        temperature FLOAT64, temperature_min FLOAT64, temperature_max FLOAT64,
+        feels_like_temp FLOAT64, humidity FLOAT64, wind_speed FLOAT64,
+        description STRING, longitude FLOAT64, latitude FLOAT64
+    )
+    PARTITION BY day CLUSTER BY city;
+'''
+
+# MERGE keeps reruns and late rows correct by combining with existing aggregates
+BIGQUERY_MERGE_SET = '''
+    WHEN MATCHED THEN UPDATE SET
+        temperature = (T.temperature * T.n + S.temperature * S.n) / (T.n + S.n),
+        temperature_min = LEAST(T.temperature_min, S.temperature_min),
+        temperature_max = GREATEST(T.temperature_max, S.temperature_max),
+        feels_like_temp = (T.feels_like_temp * T.n + S.feels_like_temp * S.n) / (T.n + S.n),
+        humidity = (T.humidity * T.n + S.humidity * S.n) / (T.n + S.n),
+        wind_speed = (T.wind_speed * T.n + S.wind_speed * S.n) / (T.n + S.n),
+        n = T.n + S.n
+    WHEN NOT MATCHED THEN INSERT ROW
+'''
+
+BIGQUERY_HOURLY_SQL = '''
+    BEGIN TRANSACTION;
+    MERGE `{hourly}` T
+    USING (
+        SELECT city, TIMESTAMP_TRUNC(timestamp, HOUR) AS hour, COUNT(*) AS n,
+               AVG(CAST(temperature AS FLOAT64)) AS temperature,
+               MIN(CAST(temperature AS FLOAT64)) AS temperature_min,
+               MAX(CAST(temperature AS FLOAT64)) AS temperature_max,
+               AVG(CAST(feels_like_temp AS FLOAT64)) AS feels_like_temp,
+               AVG(CAST(humidity AS FLOAT64)) AS humidity,
+               AVG(CAST(wind_speed AS FLOAT64)) AS wind_speed,
+               APPROX_TOP_COUNT(description, 1)[OFFSET(0)].value AS description,
+               AVG(CAST(longitude AS FLOAT64)) AS longitude,
+               AVG(CAST(latitude AS FLOAT64)) AS latitude
+        FROM `{raw}`
+        WHERE timestamp < @cutoff
+        GROUP BY city, hour
+    ) S
+    ON T.city = S.city AND T.hour = S.hour
+    {merge_set};
+    DELETE FROM `{raw}` WHERE timestamp < @cutoff;
+    COMMIT TRANSACTION;
+'''
+
+BIGQUERY_DAILY_SQL = '''
+    BEGIN TRANSACTION;
+    MERGE `{daily}` T
+    USING (
+        SELECT city, DATE(hour) AS day, SUM(n) AS n,
+               SUM(temperature * n) / SUM(n) AS temperature,
+               MIN(temperature_min) AS temperature_min,
+               MAX(temperature_max) AS temperature_max,
+               SUM(feels_like_temp * n) / SUM(n) AS feels_like_temp,
+               SUM(humidity * n) / SUM(n) AS humidity,
+               SUM(wind_speed * n) / SUM(n) AS wind_speed,
+               APPROX_TOP_COUNT(description, 1)[OFFSET(0)].value AS description,
+               AVG(longitude) AS longitude,
+               AVG(latitude) AS latitude
+        FROM `{hourly}`
+        WHERE hour < @cutoff
+        GROUP BY city, day
+    ) S
+    ON T.city = S.city AND T.day = S.day
+    {merge_set};
+    DELETE FROM `{hourly}` WHERE hour < @cutoff;
+    COMMIT TRANSACTION;
+'''
+
+def compact_bigquery_table(client, table: str, sql: str, cutoff: datetime):
+    '''
+    BigQuery counterpart of compact_postgres_table. BigQuery bills every
+    statement by the bytes it scans, and the weather table created before
+    partitioning was added is scanned in full by each one, so the whole
+    backlog is compacted in a single transaction: one MERGE and one
+    DELETE per run, however many days are due. On a partitioned table the
+    cutoff also prunes the partitions that are kept. The transaction is
+    atomic, so a failed run changes nothing and the next one redoes it.
+    '''
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('cutoff', 'TIMESTAMP', cutoff)
+    ])
+    client.query(sql, job_config=job_config).result()
+    print(f'Compacted {table} up to {cutoff}')
+
+@log_decorator
+def compact_bigquery():
+    '''Apply the retention policy to the BigQuery weather tables'''
+    if BIGQUERY_RAW_RETENTION_DAYS is None:
+        # The dbt marts (weather_data_etl_dbt) are rebuilt from the raw table,
+        # deleting raw rows would drop that history from them
+        print('BIGQUERY_RAW_RETENTION_DAYS is not set, skipping BigQuery compaction')
+        return
+
+    client = bigquery.Client(project=GCP_PROJECT)
+    tables = bigquery_tables()
+    client.query(BIGQUERY_SETUP_SQL.format(**tables)).result()
+
+    now = datetime.now(timezone.utc)
+    compact_bigquery_table(client, tables['raw'],
+                           BIGQUERY_HOURLY_SQL.format(merge_set=BIGQUERY_MERGE_SET, **tables),
+                           now - timedelta(days=int(BIGQUERY_RAW_RETENTION_DAYS)))
+    compact_bigquery_table(client, tables['hourly'],
+                           BIGQUERY_DAILY_SQL.format(merge_set=BIGQUERY_MERGE_SET, **tables),
+                           now - timedelta(days=HOURLY_RETENTION_DAYS))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Roll old weather observations into hourly and daily aggregates')
+    parser.add_argument('--backend', choices=['postgres', 'bigquery'], default='bigquery')
+    parser.add_argument('--batch-days', type=int, default=1, help='Days of data compacted per transaction (Postgres)')
+    args = parser.parse_args()
+
+    if args.backend == 'postgres':
+        compact_postgres(args.batch_days)
+    else:
+        compact_bigquery()
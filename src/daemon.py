@@ -0,0 +1,220 @@
+import os
+import time
+import heapq
+import queue
+import signal
+import argparse
+import threading
+from cities import load_cities, catalog_names
+from change_filter import ChangeFilter
+from spool import Spool
+from accuracy import AccuracyEngine
+from pipeline import init_bigquery_table, extract_city_weather_data, transform_city_weather_data, load_weather_rows_to_bigquery
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv(override=True)
+
+# Environment variables
+API_KEY = os.getenv('API_KEY')
+
+# OpenWeather recalculates current conditions about every 10 minutes
+UPDATE_CADENCE = int(os.getenv('UPDATE_CADENCE', '600'))
+# Seconds to wait after the expected update before polling again
+UPDATE_LAG = int(os.getenv('UPDATE_LAG', '30'))
+# Wait before polling again when the provider has not updated yet
+MIN_POLL_INTERVAL = int(os.getenv('MIN_POLL_INTERVAL', '60'))
+# Longest wait between polls of a station whose readings stay behind
+MAX_POLL_INTERVAL = int(os.getenv('MAX_POLL_INTERVAL', '3600'))
+FLUSH_SECONDS = int(os.getenv('FLUSH_SECONDS', '30'))
+FLUSH_ROWS = int(os.getenv('FLUSH_ROWS', '100'))
+QUEUE_SIZE = int(os.getenv('QUEUE_SIZE', '1000'))
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', '4'))
+SPOOL_REPLAY_SECONDS = int(os.getenv('SPOOL_REPLAY_SECONDS', '300'))
+
+class WeatherDaemon:
+    '''
+    Long-running ingestion: every city is polled on its own schedule,
+    aligned to when the provider is expected to publish a new reading,
+    and observations flow through a bounded queue to a single flusher
+    that transforms them and loads micro-batches of FLUSH_ROWS rows or
+    every FLUSH_SECONDS seconds, whichever comes first. A full queue
+    blocks the pollers (backpressure); SIGINT/SIGTERM stop polling,
+    drain the queue and flush what is left. Micro-batches that fail to
+    load are spooled to disk and replayed every SPOOL_REPLAY_SECONDS.
+
+    Parameters:
+    cities (list): City queries to poll
+    api_key (str): OpenWeather API key
+    sink (callable): Receives each micro-batch, returns True on success
+    '''
+
+    def __init__(self, cities: list, api_key: str, sink=load_weather_rows_to_bigquery):
+        self.api_key = api_key
+        self.sink = sink
+        self.change_filter = ChangeFilter()
+        self.spool = Spool('weather_capitals')
+        self.accuracy = AccuracyEngine()
+        # Forecasts are stored under the catalog name, only this shard's are scored
+        names = catalog_names()
+        self.forecast_cities = [names.get(city, city) for city in cities]
+        self.stop = threading.Event()
+        self.observations = queue.Queue(maxsize=QUEUE_SIZE)
+        self.due = queue.Queue(maxsize=EXTRACT_WORKERS * 2)
+        self.lock = threading.Lock()
+        # Last dt seen per city and how many polls in a row returned it
+        self.last_dt = {}
+        self.misses = {}
+
+        # Spread the first polls over one cadence to avoid a burst at startup
+        now = time.time()
+        step = UPDATE_CADENCE / max(1, len(cities))
+        self.schedule = [(now + i * step, city) for i, city in enumerate(cities)]
+        heapq.heapify(self.schedule)
+
+    def next_poll(self, city: str, data) -> float:
+        '''
+        Time of the next poll, based on when the reading was calculated.
+        Stations often report readings older than one cadence; their next
+        update cannot be predicted, so they are polled once per cadence,
+        doubling the wait (up to MAX_POLL_INTERVAL) while dt stays the same.
+        Call with self.lock held.
+        '''
+        now = time.time()
+        if not data:
+            return now + UPDATE_CADENCE
+
+        stale = self.last_dt.get(city) == data.dt
+        self.last_dt[city] = data.dt
+        self.misses[city] = self.misses.get(city, 0) + 1 if stale else 0
+
+        expected_update = data.dt + UPDATE_CADENCE + UPDATE_LAG
+        if expected_update > now + MIN_POLL_INTERVAL and not stale:
+            return expected_update
+        return now + min(UPDATE_CADENCE * 2 ** min(self.misses[city], 8), MAX_POLL_INTERVAL)
+
+    def scheduler(self):
+        '''Hand the cities that are due to the extract workers'''
+        while not self.stop.is_set():
+            with self.lock:
+                due_at, city = self.schedule[0] if self.schedule else (time.time() + 1, None)
+                if city is not None and due_at <= time.time():
+                    heapq.heappop(self.schedule)
+                else:
+                    city = None
+
+            if city is None:
+                self.stop.wait(min(1, max(0, due_at - time.time())))
+                continue
+
+            while not self.stop.is_set():
+                try:
+                    self.due.put(city, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def extractor(self):
+        '''Poll the due cities and push the raw readings to the queue'''
+        while not self.stop.is_set():
+            try:
+                city = self.due.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            data = None
+            try:
+                data = extract_city_weather_data(city, self.api_key)
+                if data:
+                    # Blocks while the flusher is behind
+                    self.observations.put(data)
+            except Exception as e:
+                print(f'Error polling {city}: {e}')
+            finally:
+                # The city is always polled again, whatever happened
+                with self.lock:
+                    heapq.heappush(self.schedule, (self.next_poll(city, data), city))
+
+    def flush(self, batch: list):
+        rows = self.change_filter.filter(batch)
+        if rows:
+            if self.sink(rows):
+                self.change_filter.remember(rows)
+                self.accuracy.record_observations(rows)
+            else:
+                self.spool.append(rows)
+                print(f'Failed to load a micro-batch of {len(rows)} rows, spooled for replay')
+        batch.clear()
+
+    def flusher(self, extractors: list):
+        '''Transform the readings and load them in micro-batches'''
+        batch = []
+        deadline = time.time() + FLUSH_SECONDS
+        next_replay = time.time()
+
+        while True:
+            # Keep draining until the pollers are gone and the queue is empty
+            if self.stop.is_set() and self.observations.empty() and not any(t.is_alive() for t in extractors):
+                break
+
+            try:
+                data = self.observations.get(timeout=max(0, min(1, deadline - time.time())))
+                transformed_data = transform_city_weather_data(data)
+                if transformed_data:
+                    batch.append(transformed_data)
+            except queue.Empty:
+                pass
+
+            if len(batch) >= FLUSH_ROWS or time.time() >= deadline:
+                self.flush(batch)
+                deadline = time.time() + FLUSH_SECONDS
+
+            if time.time() >= next_replay:
+                self.replay_spool()
+                try:
+                    self.accuracy.sync_forecasts(self.forecast_cities)
+                    self.accuracy.publish_stats()
+                except Exception as e:
+                    # Accuracy bookkeeping must never stop the ingestion
+                    print(f'Error while updating forecast accuracy: {e}')
+                next_replay = time.time() + SPOOL_REPLAY_SECONDS
+
+        self.flush(batch)
+        self.spool.seal()
+
+    def replay_spool(self):
+        '''Load the spooled micro-batches, recording them as the last seen per city'''
+        def load_spooled_rows(rows: list) -> bool:
+            if not self.sink(rows):
+                return False
+            self.change_filter.remember(rows)
+            self.accuracy.record_observations(rows)
+            return True
+
+        self.spool.replay(load_spooled_rows)
+
+    def shutdown(self, signum=None, frame=None):
+        print('Shutting down, flushing pending observations...')
+        self.stop.set()
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGTERM, self.shutdown)
+
+        extractors = [threading.Thread(target=self.extractor, daemon=True) for _ in range(EXTRACT_WORKERS)]
+        threads = [threading.Thread(target=self.scheduler, daemon=True)] + extractors
+        for thread in threads:
+            thread.start()
+
+        # The flusher runs in the main thread so signals are handled promptly
+        self.flusher(extractors)
+        print(f"Daemon stopped, {self.change_filter.stats['suppressed']} unchanged readings skipped")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Continuously ingest the weather of a shard of the city catalog')
+    parser.add_argument('--cities-file', default=None, help='CSV city catalog (defaults to CITIES_FILE or src/cities.csv)')
+    parser.add_argument('--shard', default=os.getenv('SHARD'), help='Shard of the catalog to poll, in the form i/n')
+    args = parser.parse_args()
+
+    init_bigquery_table()
+    WeatherDaemon(load_cities(args.cities_file, args.shard), API_KEY).run()
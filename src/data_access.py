@@ -0,0 +1,57 @@
+from decimal import Decimal
+import pandas as pd
+
+OPENWEATHER_ICON_PREFIX = 'https://openweathermap.org/img/wn/'
+OPENWEATHER_ICON_SUFFIX = '@2x.png'
+
+# Text columns repeating fewer distinct values than this share of rows become categoricals
+CATEGORICAL_MAX_RATIO = 0.5
+
+def icon_url(icon: str) -> str:
+    '''Rebuild the icon URL from the code kept by compact_frame'''
+    if icon is None or pd.isna(icon):
+        return None
+    if icon.startswith(('http:', 'https:', '//')):
+        return icon
+    return f'{OPENWEATHER_ICON_PREFIX}{icon}{OPENWEATHER_ICON_SUFFIX}'
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Shrink a weather DataFrame for the dashboards: icon_url is replaced
+    by the short icon code it is built from, repeated text becomes
+    categorical, NUMERIC values (Decimal objects) and float64 become
+    float32, and integers are downcast to the smallest type that fits
+
+    Parameters:
+    df (DataFrame): Rows as read from the database
+
+    Returns:
+    DataFrame: Compact copy of the data
+    '''
+    df = df.drop(columns=['rn'], errors='ignore')
+
+    if 'icon_url' in df.columns:
+        icon = df['icon_url'].str.removeprefix(OPENWEATHER_ICON_PREFIX).str.removesuffix(OPENWEATHER_ICON_SUFFIX)
+        df = df.drop(columns=['icon_url']).assign(icon=icon)
+
+    for column in df.columns:
+        values = df[column]
+
+        if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+            sample = values.dropna()
+            if sample.empty:
+                continue
+            if isinstance(sample.iloc[0], Decimal):
+                df[column] = pd.to_numeric(values, errors='coerce').astype('float32')
+            elif isinstance(sample.iloc[0], str) and values.nunique() <= CATEGORICAL_MAX_RATIO * len(values):
+                df[column] = values.astype('category')
+        elif pd.api.types.is_float_dtype(values):
+            df[column] = values.astype('float32')
+        elif pd.api.types.is_integer_dtype(values):
+            df[column] = pd.to_numeric(values, downcast='integer')
+
+    return df
+
+def memory_footprint(df: pd.DataFrame) -> str:
+    '''Human readable memory used by a DataFrame, including string contents'''
+    return f'{df.memory_usage(deep=True).sum() / 1024 ** 2:.2f} MB'
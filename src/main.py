@@ -1,6 +1,12 @@
 import os
-import time
-from pipeline import init_bigquery_table, extract_city_weather_data, transform_city_weather_data, load_weather_data_to_bigquery
+import argparse
+import threading
+from cities import load_cities, catalog_names
+from change_filter import ChangeFilter
+from spool import Spool
+from accuracy import AccuracyEngine
+from stages import Stage, StagedPipeline
+from pipeline import init_bigquery_table, extract_city_weather_data, transform_city_weather_data, load_weather_rows_to_bigquery
 from utils_log import log_decorator
 from dotenv import load_dotenv
 
@@ -9,51 +15,141 @@ load_dotenv(override=True)
 
 # Environment variables
 API_KEY = os.getenv('API_KEY')
+# Worker threads per pipeline stage
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', '4'))
+TRANSFORM_WORKERS = int(os.getenv('TRANSFORM_WORKERS', '1'))
+LOAD_WORKERS = int(os.getenv('LOAD_WORKERS', '1'))
+# Rows loaded per insert, or whatever arrived within LOAD_BATCH_SECONDS
+LOAD_BATCH_ROWS = int(os.getenv('LOAD_BATCH_ROWS', '50'))
+LOAD_BATCH_SECONDS = float(os.getenv('LOAD_BATCH_SECONDS', '5'))
+
+# Skips cities whose reading did not change since the last load
+change_filter = ChangeFilter()
+
+# Rows that failed to load, replayed at the start of the next run
+spool = Spool('weather_capitals')
+
+# Forecast accuracy, updated with every observation loaded
+accuracy = AccuracyEngine()
+
+# The change filter, spool and accuracy engine are shared by the load workers
+bookkeeping_lock = threading.Lock()
+
+def replay_spool() -> int:
+    '''Load the spooled rows and record them as the last seen per city'''
+    def load_spooled_rows(rows: list) -> bool:
+        if not load_weather_rows_to_bigquery(rows):
+            return False
+        change_filter.remember(rows)
+        accuracy.record_observations(rows)
+        return True
+
+    return spool.replay(load_spooled_rows)
+
+def load_stage(rows: list) -> list:
+    '''Load a batch of changed rows, spooling it when the load fails'''
+    with bookkeeping_lock:
+        rows = change_filter.filter(rows)
+    if not rows:
+        print('Skipping batch, readings unchanged since the last load')
+        return None
+
+    success = load_weather_rows_to_bigquery(rows)
+    with bookkeeping_lock:
+        if success:
+            change_filter.remember(rows)
+            accuracy.record_observations(rows)
+        else:
+            spool.append(rows)
+
+    if not success:
+        print(f'Failed to load {len(rows)} rows, spooled for the next run')
+        return None
+    print(f"Successfully processed {', '.join(row['city'] for row in rows)}!")
+    return rows
+
+@log_decorator
+def run_pipeline(cities: list, api_key: str = None) -> dict:
+    '''
+    Extract, transform and load the weather of the cities as separate
+    stages connected by bounded queues, so API calls for some cities
+    overlap with the loads of others and memory stays bounded however
+    long the city list is
+
+    Parameters:
+    cities (list): City queries to process
+    api_key (str): OpenWeather API key, defaults to API_KEY
+
+    Returns:
+    dict: Items passed, dropped and failed per stage
+    '''
+    api_key = api_key or API_KEY
+
+    # One-time setup, before any city is processed
+    init_bigquery_table()
+
+    pipeline = StagedPipeline([
+        Stage('extract', lambda city: extract_city_weather_data(city, api_key), workers=EXTRACT_WORKERS),
+        Stage('transform', transform_city_weather_data, workers=TRANSFORM_WORKERS),
+        Stage('load', load_stage, workers=LOAD_WORKERS, batch_size=LOAD_BATCH_ROWS, batch_seconds=LOAD_BATCH_SECONDS),
+    ])
+    return pipeline.run(cities)
 
 @log_decorator
-def run_pipeline(city):
-    try:
-        # Initialize database
-        init_bigquery_table()
-
-        # Fetch weather data
-        weather_data = extract_city_weather_data(city, API_KEY)
-
-        # Fetch weather data
-        if weather_data:
-            transformed_data = transform_city_weather_data(weather_data)
-
-            # Store data
-            if transformed_data:
-                success = load_weather_data_to_bigquery(transformed_data)
-                if success:
-                    print(f'Successfully processed {city}!')
-                else:
-                    print(f'Failed to load {city}')
-            else:
-                print(f'Failed to transform data for {city}')
+def extract_shard(shard: str = None, api_key: str = None, cities_file: str = None, cities: list = None) -> dict:
+    '''
+    Extract and transform the weather of every city in a shard,
+    without loading it, so extraction and loading can run and
+    retry as separate stages
+
+    Parameters:
+    shard (str): Shard of the catalog in the form "i/n", or None for all cities
+    api_key (str): OpenWeather API key, defaults to API_KEY
+    cities_file (str): CSV city catalog
+    cities (list): City queries to extract instead of the shard, e.g. to retry failures
+
+    Returns:
+    dict: Transformed rows and the cities that could not be extracted
+    '''
+    rows, failed = [], []
+
+    # Transforming is cheap, so it shares the extraction workers
+    def extract(city: str) -> dict:
+        weather_data = extract_city_weather_data(city, api_key or API_KEY)
+        transformed_data = transform_city_weather_data(weather_data) if weather_data else None
+
+        if transformed_data:
+            rows.append(transformed_data)
         else:
-            print(f'Failed to extract data for {city}')
+            failed.append(city)
+        return transformed_data
 
-    except Exception as e:
-        print(f'Pipeline failed for {city}: {e}')
-        raise
+    if cities is None:
+        cities = load_cities(cities_file, shard)
+
+    StagedPipeline([Stage('extract', extract, workers=EXTRACT_WORKERS)]).run(cities)
+    return {'rows': rows, 'failed': failed}
 
 if __name__ == "__main__":
-    # List of capitals from Brazil
-    # brazilian_capitals = [
-    #     "Aracaju", "Belém", "Belo Horizonte", "Boa Vista", "Brasília", "Campo Grande",
-    #     "Cuiabá", "Curitiba", "Florianópolis", "Fortaleza", "Goiânia", "João Pessoa",
-    #     "Macapá", "Maceió", "Manaus", "Natal", "Palmas", "Porto Alegre", "Porto Velho",
-    #     "Recife", "Rio Branco", "Rio de Janeiro", "Salvador,BA,BR", "São Luís", "São Paulo",
-    #     "Teresina", "Vitória"
-    # ]
-
-    test_cities = ["São Paulo", "Rio de Janeiro", "Brasília"]
-    for city in test_cities:
-        run_pipeline(city)
-        time.sleep(2)
-
-    print("Test complete! Check BigQuery console.")
-
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Run the weather ETL for a shard of the city catalog')
+    parser.add_argument('--cities-file', default=None, help='CSV city catalog (defaults to CITIES_FILE or src/cities.csv)')
+    parser.add_argument('--shard', default=os.getenv('SHARD'), help='Shard of the catalog to process, in the form i/n')
+    parser.add_argument('--replay-spool', action='store_true', help='Only load the rows spooled by failed runs, then exit')
+    args = parser.parse_args()
+
+    replay_spool()
+    if args.replay_spool:
+        raise SystemExit(0)
+
+    cities = load_cities(args.cities_file, args.shard)
+    names = catalog_names(args.cities_file)
+    accuracy.sync_forecasts([names.get(city, city) for city in cities])
+
+    stats = run_pipeline(cities)
+    spool.seal()
+
+    accuracy.publish_stats()
+
+    print(f"Processed {len(cities)} cities! Check BigQuery console.")
+    print(f"Stage stats: {stats}")
+    print(f"Unchanged readings skipped: {change_filter.stats['suppressed']}")
@@ -5,6 +5,8 @@ import json
 from google.cloud import bigquery
 from datetime import datetime
 from utils_log import log_decorator
+from rate_limit import rate_limited_get
+from schemas import OpenWeatherCurrent, PayloadError, decode_openweather_current
 from dotenv import load_dotenv
 
 # Load environment variables from .env
@@ -16,7 +18,7 @@ DATASET_ID = os.getenv('DATASET_ID')
 TABLE_ID = os.getenv('TABLE_ID')
 
 @log_decorator
-def extract_city_weather_data(city: str, api_key: str) -> dict:
+def extract_city_weather_data(city: str, api_key: str) -> OpenWeatherCurrent:
     '''
     Fetch raw weather data for a chosen city using OpenWeather API
     
@@ -25,7 +27,7 @@ def extract_city_weather_data(city: str, api_key: str) -> dict:
     api_key (str): OpenWeather API key
     
     Returns:
-    dict: Weather data for the city
+    OpenWeatherCurrent: Weather data for the city
 	'''
     api_url = 'https://api.openweathermap.org/data/2.5/weather'
     
@@ -36,39 +38,42 @@ def extract_city_weather_data(city: str, api_key: str) -> dict:
 	}
     
     try:
-        response = requests.get(api_url, params=params)
+        response = rate_limited_get('openweather', api_url, params)
         response.raise_for_status()
-        city_weather_data = response.json()
+        city_weather_data = decode_openweather_current(response.content)
         
         return city_weather_data
         
     except requests.exceptions.RequestException as e:
         print(f'Error fetching data: {e}')
+    except PayloadError as e:
+        print(f'Error decoding data for {city}: {e}')
 
 @log_decorator  
-def transform_city_weather_data(data: dict) -> dict:
+def transform_city_weather_data(data: OpenWeatherCurrent) -> dict:
     '''
     Transform raw data into a more organized dictionary,
     selecting only the important informations, ready to
     load into database
     
     Parameters:
-    data (dict): Raw weather data
+    data (OpenWeatherCurrent): Decoded weather data
     
     Returns:
     dict: Transformed weather data
 	'''
     transformed_weather_data = {
-        'timestamp': datetime.fromtimestamp(data['dt']).isoformat(),
-        'city': data['name'],
-        'temperature': round(data['main']['temp'], 2),
-        'feels_like_temp': round(data['main']['feels_like'], 2),
-        'humidity': data['main']['humidity'],
-        'wind_speed': data['wind']['speed'],
-        'description': data['weather'][0]['description'],
-        'icon_url': f"https://openweathermap.org/img/wn/{data['weather'][0]['icon']}@2x.png",
-        'longitude': data['coord']['lon'],
-        'latitude': data['coord']['lat']
+        'timestamp': datetime.fromtimestamp(data.dt).isoformat(),
+        'city': data.name,
+        'temperature': round(data.main.temp, 2),
+        'feels_like_temp': round(data.main.feels_like, 2),
+        'humidity': data.main.humidity,
+        'wind_speed': data.wind.speed,
+        'description': data.weather[0].description,
+        'icon_url': f"https://openweathermap.org/img/wn/{data.weather[0].icon}@2x.png",
+        'longitude': data.coord.lon,
+        'latitude': data.coord.lat,
+        'source': 'openweather'
 	}
     
     return transformed_weather_data
@@ -81,7 +86,7 @@ def init_bigquery_table():
     table_ref = client.dataset(DATASET_ID).table(TABLE_ID)
 
     try:
-        client.get_table(table_ref)
+        table = client.get_table(table_ref)
         print(f'Table {GCP_PROJECT}.{DATASET_ID}.{TABLE_ID} already exists.')
     except Exception:
         print(f'Table does not exist, creating it...')
@@ -97,35 +102,66 @@ def init_bigquery_table():
             bigquery.SchemaField("icon_url", "STRING"),
             bigquery.SchemaField("longitude", "NUMERIC"),
             bigquery.SchemaField("latitude", "NUMERIC"),
+            bigquery.SchemaField("source", "STRING"),
             bigquery.SchemaField("created_at", "TIMESTAMP", default_value_expression="CURRENT_TIMESTAMP()"),
         ]
 
         table = bigquery.Table(table_ref, schema=schema)
+        # Lets compaction (src/compaction.py) and dashboards scan only the days they touch
+        table.time_partitioning = bigquery.TimePartitioning(field="timestamp")
+        table.clustering_fields = ["city"]
         table = client.create_table(table)
         print(f"Created table {table.project}.{table.dataset_id}.{table.table_id}")  
+        return
+
+    # Tables created before rows carried their provider
+    if 'source' not in [field.name for field in table.schema]:
+        table.schema = list(table.schema) + [bigquery.SchemaField("source", "STRING")]
+        client.update_table(table, ["schema"])
+        print('Added source column to the table')
 
 @log_decorator
-def load_weather_data_to_bigquery(data: dict):
+def load_weather_data_to_bigquery(data: dict) -> bool:
     '''
     Load the transformed weather data into BigQuery
     '''
     if not data:
         print('No data to load')
-    
+        return False
+
+    return load_weather_rows_to_bigquery([data])
+
+@log_decorator
+def load_weather_rows_to_bigquery(rows: list) -> bool:
+    '''
+    Load a batch of transformed weather rows into BigQuery
+    with a single streaming insert
+
+    Parameters:
+    rows (list): Transformed weather data, one dict per city
+
+    Returns:
+    bool: True if every row was inserted
+    '''
+    if not rows:
+        print('No data to load')
+        return True
+
     client = bigquery.Client(project=GCP_PROJECT)
     table_id = f'{GCP_PROJECT}.{DATASET_ID}.{TABLE_ID}'
 
-    rows_to_insert = [data]
-
     try:
-        errors = client.insert_rows_json(table_id, rows_to_insert)
+        errors = client.insert_rows_json(table_id, rows)
 
         if errors:
             print(f'BigQuery insert errors: {errors}')
-        else:
-            print(f'Sucessfully inserted data for {data["city"]}')
+            return False
+
+        print(f'Sucessfully inserted data for {", ".join(row["city"] for row in rows)}')
+        return True
     except Exception as e:
         print(f'Error while inserting data to BigQuery: {e}')
+        return False
 
 @log_decorator
 def test_bigquery_connection():
@@ -0,0 +1,151 @@
+import os
+import time
+import sqlite3
+import requests
+import tempfile
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv(override=True)
+
+# Environment variables
+MAX_THROTTLE_RETRIES = int(os.getenv('MAX_THROTTLE_RETRIES', '3'))
+RATE_LIMIT_DB = os.getenv('RATE_LIMIT_DB', os.path.join(tempfile.gettempdir(), 'weather_rate_limit.db'))
+
+# Plan ceilings per provider, in calls per minute
+CALLS_PER_MINUTE = {
+    'openweather': float(os.getenv('OPENWEATHER_CALLS_PER_MINUTE', '60')),
+    'weatherapi': float(os.getenv('WEATHERAPI_CALLS_PER_MINUTE', '20')),
+}
+
+# Seconds a throttled bucket takes to climb back to the plan ceiling
+RECOVERY_SECONDS = 300
+
+class RateLimiter:
+    '''
+    Token bucket shared by every process that points to the same SQLite
+    file. Each acquire() refills the bucket from the elapsed time and takes
+    one token inside an exclusive transaction, so concurrent extractors
+    never go past the plan's calls per minute together. A 429 halves the
+    refill rate and blocks the bucket for the Retry-After interval; the
+    rate then climbs back linearly to the ceiling.
+
+    Parameters:
+    provider (str): Bucket name, one per API plan
+    calls_per_minute (float): Plan ceiling
+    burst (float): Bucket capacity, defaults to one second worth of calls
+    path (str): SQLite file shared by the workers
+    '''
+
+    def __init__(self, provider: str, calls_per_minute: float, burst: float = None, path: str = None):
+        self.provider = provider
+        self.calls_per_minute = calls_per_minute
+        self.burst = burst or max(1.0, calls_per_minute / 60)
+        self.path = path or RATE_LIMIT_DB
+
+        conn = self._connect()
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    provider TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    rate REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    blocked_until REAL NOT NULL
+                )
+            ''')
+            conn.execute(
+                'INSERT OR IGNORE INTO buckets VALUES (?, ?, ?, ?, 0)',
+                (provider, self.burst, calls_per_minute, time.time())
+            )
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _refill(self, conn, now: float) -> tuple:
+        tokens, rate, updated_at, blocked_until = conn.execute(
+            'SELECT tokens, rate, updated_at, blocked_until FROM buckets WHERE provider = ?',
+            (self.provider,)
+        ).fetchone()
+        elapsed = max(0.0, now - updated_at)
+        rate = min(self.calls_per_minute, rate + elapsed * self.calls_per_minute / RECOVERY_SECONDS)
+        tokens = min(self.burst, tokens + elapsed * rate / 60)
+        return tokens, rate, blocked_until
+
+    def _store(self, conn, tokens: float, rate: float, now: float, blocked_until: float):
+        conn.execute(
+            'UPDATE buckets SET tokens = ?, rate = ?, updated_at = ?, blocked_until = ? WHERE provider = ?',
+            (tokens, rate, now, blocked_until, self.provider)
+        )
+
+    def acquire(self):
+        '''Block until a call is allowed for this provider'''
+        conn = self._connect()
+        try:
+            while True:
+                conn.execute('BEGIN IMMEDIATE')
+                now = time.time()
+                tokens, rate, blocked_until = self._refill(conn, now)
+
+                if now >= blocked_until and tokens >= 1:
+                    self._store(conn, tokens - 1, rate, now, blocked_until)
+                    conn.execute('COMMIT')
+                    return
+
+                self._store(conn, tokens, rate, now, blocked_until)
+                conn.execute('COMMIT')
+                wait = max(blocked_until - now, (1 - tokens) * 60 / rate)
+                time.sleep(wait)
+        finally:
+            conn.close()
+
+    def throttled(self, retry_after: float = None):
+        '''
+        Record a 429 from the provider: empty the bucket, halve the rate
+        and block every worker until Retry-After (or one refill) has passed
+        '''
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            _, rate, blocked_until = self._refill(conn, now)
+            rate = max(1.0, rate / 2)
+            blocked_until = max(blocked_until, now + (retry_after if retry_after is not None else 60 / rate))
+            self._store(conn, 0.0, rate, now, blocked_until)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        print(f'Rate limited by {self.provider}, slowing down to {rate:.1f} calls per minute')
+
+_limiters = {}
+
+def get_rate_limiter(provider: str) -> RateLimiter:
+    '''Return the process-wide limiter for a provider configured in CALLS_PER_MINUTE'''
+    if provider not in _limiters:
+        _limiters[provider] = RateLimiter(provider, CALLS_PER_MINUTE[provider])
+    return _limiters[provider]
+
+def retry_after_seconds(response) -> float:
+    '''Parse the Retry-After header of a 429 response, if present'''
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def rate_limited_get(provider: str, api_url: str, params: dict, on_request=None):
+    '''
+    GET through the provider's shared token bucket, backing off on 429.
+    on_request is called once a token is acquired, right before each request is sent
+    '''
+    limiter = get_rate_limiter(provider)
+    for _ in range(MAX_THROTTLE_RETRIES + 1):
+        limiter.acquire()
+        if on_request:
+            on_request()
+        response = requests.get(api_url, params=params, timeout=10)
+        if response.status_code != 429:
+            break
+        limiter.throttled(retry_after_seconds(response))
+    return response
@@ -10,5 +10,43 @@ CREATE TABLE IF NOT EXISTS weather_capitals (
     icon_url VARCHAR(100),
     longitude NUMERIC (8,6),
     latitude NUMERIC (8,6),
+    source VARCHAR(20),
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+);
+
+ALTER TABLE weather_capitals ADD COLUMN IF NOT EXISTS source VARCHAR(20);
+
+-- Raw rows are rolled into these aggregates by src/compaction.py once past retention
+CREATE INDEX IF NOT EXISTS weather_capitals_timestamp_idx ON weather_capitals (timestamp);
+
+CREATE TABLE IF NOT EXISTS weather_capitals_hourly (
+    city VARCHAR(100) NOT NULL,
+    hour TIMESTAMP NOT NULL,
+    n INTEGER NOT NULL,
+    temperature NUMERIC (5,2),
+    temperature_min NUMERIC (5,2),
+    temperature_max NUMERIC (5,2),
+    feels_like_temp NUMERIC (5,2),
+    humidity NUMERIC (5,2),
+    wind_speed NUMERIC (5,2),
+    description VARCHAR(100),
+    longitude NUMERIC (8,6),
+    latitude NUMERIC (8,6),
+    PRIMARY KEY (city, hour)
+);
+
+CREATE TABLE IF NOT EXISTS weather_capitals_daily (
+    city VARCHAR(100) NOT NULL,
+    day DATE NOT NULL,
+    n INTEGER NOT NULL,
+    temperature NUMERIC (5,2),
+    temperature_min NUMERIC (5,2),
+    temperature_max NUMERIC (5,2),
+    feels_like_temp NUMERIC (5,2),
+    humidity NUMERIC (5,2),
+    wind_speed NUMERIC (5,2),
+    description VARCHAR(100),
+    longitude NUMERIC (8,6),
+    latitude NUMERIC (8,6),
+    PRIMARY KEY (city, day)
+);
@@ -0,0 +1,51 @@
+import msgspec
+from typing import Annotated
+
+# Typed views of the API payloads. Only the fields the pipeline uses are
+# declared: msgspec skips everything else while decoding straight from the
+# response bytes and validates types in the same pass. Structs are
+# slot-based and untracked by the GC, so each record stays cheap.
+
+class PayloadError(ValueError):
+    '''Raised when an API response does not match the expected schema'''
+
+class Coord(msgspec.Struct, gc=False):
+    lon: float
+    lat: float
+
+class Main(msgspec.Struct, gc=False):
+    temp: float
+    feels_like: float
+    humidity: int
+
+class Wind(msgspec.Struct, gc=False):
+    speed: float
+
+class Condition(msgspec.Struct, gc=False):
+    description: str
+    icon: str
+
+class OpenWeatherCurrent(msgspec.Struct, gc=False):
+    dt: int
+    name: str
+    main: Main
+    wind: Wind
+    weather: Annotated[list[Condition], msgspec.Meta(min_length=1)]
+    coord: Coord
+
+_openweather_current_decoder = msgspec.json.Decoder(OpenWeatherCurrent)
+
+def decode_openweather_current(payload: bytes) -> OpenWeatherCurrent:
+    '''
+    Decode and validate an OpenWeather current weather response
+
+    Parameters:
+    payload (bytes): Raw response body
+
+    Returns:
+    OpenWeatherCurrent: Typed weather record
+    '''
+    try:
+        return _openweather_current_decoder.decode(payload)
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        raise PayloadError(f'Invalid OpenWeather payload: {e}') from e
@@ -0,0 +1,126 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371.0
+
+# min_lat, max_lat, min_lon, max_lon
+BRAZIL_BOUNDS = (-34.0, 5.5, -74.0, -34.5)
+
+def to_unit_vectors(latitude, longitude) -> np.ndarray:
+    '''
+    Project coordinates on the unit sphere, so the euclidean distance used
+    by the KD-tree grows monotonically with the great-circle distance
+    '''
+    lat = np.radians(np.asarray(latitude, dtype=np.float64))
+    lon = np.radians(np.asarray(longitude, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+class StationIndex:
+    '''
+    Spatial index of the latest reading per city, used to estimate the
+    weather at arbitrary points without a database query per point.
+
+    Stations are indexed in a KD-tree over their unit-sphere coordinates.
+    New readings of known cities only overwrite their values in place; the
+    tree is rebuilt lazily, and only when a new city shows up.
+
+    Parameters:
+    fields (tuple): Numeric columns to interpolate
+    '''
+
+    def __init__(self, fields: tuple = ('temperature', 'humidity')):
+        self.fields = fields
+        self.positions = {}
+        self.coordinates = np.empty((0, 3))
+        self.values = {field: np.empty(0) for field in fields}
+        self.tree = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def update(self, rows: list):
+        '''
+        Merge the latest rows into the index
+
+        Parameters:
+        rows (list): Transformed weather rows with latitude and longitude
+        '''
+        new_rows = []
+        for row in rows:
+            if row['city'] not in self.positions:
+                self.positions[row['city']] = len(self.positions)
+                new_rows.append(row)
+
+        if new_rows:
+            latitude = [float(row['latitude']) for row in new_rows]
+            longitude = [float(row['longitude']) for row in new_rows]
+            self.coordinates = np.vstack((self.coordinates, to_unit_vectors(latitude, longitude)))
+            for field in self.fields:
+                self.values[field] = np.concatenate((self.values[field], np.full(len(new_rows), np.nan)))
+            self.tree = None
+
+        for row in rows:
+            position = self.positions[row['city']]
+            for field in self.fields:
+                value = row.get(field)
+                self.values[field][position] = np.nan if value is None else float(value)
+
+    def _tree(self) -> cKDTree:
+        if self.tree is None:
+            self.tree = cKDTree(self.coordinates)
+        return self.tree
+
+    def interpolate(self, latitude, longitude, k: int = 4, power: float = 2.0) -> dict:
+        '''
+        Inverse-distance weighted estimate from the k nearest stations
+
+        Parameters:
+        latitude (array-like): Latitudes of the query points
+        longitude (array-like): Longitudes of the query points
+        k (int): Number of neighbours, 1 gives nearest-station values
+        power (float): Distance exponent of the weights
+
+        Returns:
+        dict: One array per field, aligned with the query points
+        '''
+        if not self.positions:
+            raise ValueError('The index has no stations yet')
+
+        k = min(k, len(self.positions))
+        chord, neighbours = self._tree().query(to_unit_vectors(latitude, longitude), k=k)
+        if k == 1:
+            chord, neighbours = chord[:, None], neighbours[:, None]
+
+        distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+        # A point on top of a station takes its value
+        weights = 1 / np.maximum(distance, 1e-6) ** power
+
+        estimates = {}
+        for field in self.fields:
+            values = self.values[field][neighbours]
+            field_weights = np.where(np.isnan(values), 0, weights)
+            total = field_weights.sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                estimates[field] = np.where(total > 0, (np.nan_to_num(values) * field_weights).sum(axis=1) / total, np.nan)
+        return estimates
+
+    def grid(self, bounds: tuple = BRAZIL_BOUNDS, step: float = 0.5, k: int = 4, power: float = 2.0) -> dict:
+        '''
+        Interpolate the fields over a regular latitude/longitude grid
+
+        Parameters:
+        bounds (tuple): min_lat, max_lat, min_lon, max_lon
+        step (float): Grid spacing in degrees
+
+        Returns:
+        dict: Flattened "latitude" and "longitude" of the grid points plus one array per field
+        '''
+        min_lat, max_lat, min_lon, max_lon = bounds
+        latitude, longitude = np.meshgrid(
+            np.arange(min_lat, max_lat + step / 2, step),
+            np.arange(min_lon, max_lon + step / 2, step),
+            indexing='ij'
+        )
+        estimates = self.interpolate(latitude.ravel(), longitude.ravel(), k=k, power=power)
+        return {'latitude': latitude.ravel(), 'longitude': longitude.ravel(), **estimates}
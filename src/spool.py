@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import threading
+from utils_log import log_decorator
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv(override=True)
+
+# Environment variables
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+# Rows written between two fsyncs of the active segment
+SPOOL_FSYNC_EVERY = int(os.getenv('SPOOL_FSYNC_EVERY', '50'))
+# Size at which the active segment is sealed; a sealed segment is replayed in one insert
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', str(1024 * 1024)))
+# Replays a segment may fail while others succeed before it goes to the dead-letter folder
+SPOOL_MAX_ATTEMPTS = int(os.getenv('SPOOL_MAX_ATTEMPTS', '5'))
+# Active segments untouched for this long belong to a process that died
+SPOOL_STALE_SECONDS = int(os.getenv('SPOOL_STALE_SECONDS', '3600'))
+
+class Spool:
+    '''
+    Local append-only spool for rows that failed to load, so a warehouse
+    outage costs neither data nor a new call to the weather API.
+
+    Rows are appended as JSON lines to an active segment ("*.part") that
+    is fsynced every SPOOL_FSYNC_EVERY rows and sealed once it reaches
+    SPOOL_SEGMENT_BYTES. replay() loads each sealed segment in a single
+    batch and deletes it on success. A segment that keeps failing while
+    other segments load fine is moved to the "dead" folder for
+    inspection instead of blocking the spool forever. A replay claims
+    each segment by renaming it first, so processes sharing the spool
+    never load the same segment twice.
+
+    Parameters:
+    name (str): Spool name, one per destination table
+    directory (str): Root folder of the spools
+    '''
+
+    def __init__(self, name: str, directory: str = None):
+        self.path = os.path.join(directory or SPOOL_DIR, name)
+        self.dead_path = os.path.join(self.path, 'dead')
+        os.makedirs(self.dead_path, exist_ok=True)
+        self.segment = None
+        self.unsynced = 0
+
+    def _open_segment(self):
+        name = f'{time.time_ns()}-{os.getpid()}.0.jsonl.part'
+        self.segment = open(os.path.join(self.path, name), 'a', encoding='utf-8')
+
+    def append(self, rows: list):
+        '''
+        Write rows to the active segment
+
+        Parameters:
+        rows (list): Rows that could not be loaded
+        '''
+        if not rows:
+            return
+
+        if self.segment is None:
+            self._open_segment()
+
+        for row in rows:
+            self.segment.write(json.dumps(row, default=str) + '\n')
+        self.unsynced += len(rows)
+
+        if self.unsynced >= SPOOL_FSYNC_EVERY:
+            self._sync()
+        if self.segment.tell() >= SPOOL_SEGMENT_BYTES:
+            self.seal()
+
+    def _sync(self):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.unsynced = 0
+
+    def seal(self):
+        '''Fsync and close the active segment, making it available for replay'''
+        if self.segment is None:
+            return
+
+        self._sync()
+        self.segment.close()
+        os.replace(self.segment.name, self.segment.name[:-len('.part')])
+        self.segment = None
+
+    def _sealed_segments(self) -> list:
+        now = time.time()
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            try:
+                # Adopt segments left open by a process that crashed
+                if name.endswith('.part') and now - os.path.getmtime(file_path) > SPOOL_STALE_SECONDS:
+                    os.replace(file_path, file_path[:-len('.part')])
+                # Release segments claimed by a replay that crashed (the rename updated ctime)
+                elif name.endswith('.claim') and now - os.path.getctime(file_path) > SPOOL_STALE_SECONDS:
+                    os.replace(file_path, os.path.join(self.path, name.rsplit('.', 2)[0]))
+            except FileNotFoundError:
+                # Another process got to it first
+                continue
+
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.jsonl'))
+
+    def _claim(self, name: str) -> str:
+        # Renaming is atomic, so only one of several processes sharing the spool gets the segment
+        claimed = os.path.join(self.path, f'{name}.{os.getpid()}-{threading.get_ident()}.claim')
+        try:
+            os.replace(os.path.join(self.path, name), claimed)
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    def _read_segment(self, file_path: str) -> list:
+        rows = []
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Torn last line of a segment that was not fsynced
+                    continue
+        return rows
+
+    @log_decorator
+    def replay(self, loader) -> int:
+        '''
+        Load every sealed segment back into the warehouse
+
+        Parameters:
+        loader (callable): Receives a list of rows, returns True on success
+
+        Returns:
+        int: Number of rows replayed
+        '''
+        self.seal()
+        replayed, failed = 0, []
+
+        for name in self._sealed_segments():
+            claimed = self._claim(name)
+            if claimed is None:
+                continue
+            rows = self._read_segment(claimed)
+
+            if not rows or loader(rows):
+                os.remove(claimed)
+                replayed += len(rows)
+            else:
+                failed.append((name, claimed))
+
+        # Only count an attempt against a segment when others went through,
+        # otherwise the warehouse itself is down
+        for name, claimed in failed:
+            stamp, attempts, _ = name.rsplit('.', 2)
+            if not replayed:
+                os.replace(claimed, os.path.join(self.path, name))
+                continue
+            target = self.dead_path if int(attempts) + 1 >= SPOOL_MAX_ATTEMPTS else self.path
+            os.replace(claimed, os.path.join(target, f'{stamp}.{int(attempts) + 1}.jsonl'))
+
+        print(f'Replayed {replayed} spooled rows, {len(failed)} segments failed to load')
+        return replayed